@@ -1,25 +1,343 @@
 """
 Answer to https://adventofcode.com/2018/day/1
 """
-with open('input.txt') as f:
-    changes = [int(l) for l in f.readlines()]
+import os
+from array import array
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool
+from typing import Iterable, List
 
-freq = 0
-freq_history = set()
-final_freq = None
-loops = 0
+import numpy as np
 
-while final_freq is None:
+
+def load(filename: str):  # -> List[int]
+    with open(filename) as f:
+        return [int(l) for l in f.readlines()]
+
+
+def stabilised(changes: List[int]):  # -> int
+    return sum(changes)
+
+
+def first_duplicate_loop(changes: List[int]):  # -> Tuple[int, int]
+    # Reference implementation: replay the changes until a frequency is seen twice
+    freq = 0
+    freq_history = set()
+    final_freq = None
+    loops = 0
+
+    while final_freq is None:
+        for l in changes:
+            freq += l
+            if freq in freq_history:
+                final_freq = freq
+                break
+            freq_history.add(freq)
+        loops += 1
+
+    return final_freq, loops
+
+
+def first_duplicate(changes: List[int]):  # -> Tuple[int, int]
+    # Every pass visits the first pass' frequencies shifted by the net drift, so
+    # freq[i] + k * drift can only hit freq[j] when both share the same residue
+    # modulo the drift. Returns the same (freq, loops) as first_duplicate_loop
+    # and (None, None) when the frequencies never repeat.
+    seen = set()
+    prefix = []
+    freq = 0
     for l in changes:
         freq += l
-        if freq in freq_history:
-            final_freq = freq
+        if freq in seen:
+            return freq, 1
+        seen.add(freq)
+        prefix.append(freq)
+
+    drift = freq
+    if not prefix:
+        return None, None
+    if 0 == drift:
+        return prefix[0], 2
+
+    groups = defaultdict(list)
+    for i, f in enumerate(prefix):
+        groups[f % abs(drift)].append((f, i))
+
+    best = None  # (extra loops, index in the pass, freq)
+    for group in groups.values():
+        group.sort(reverse=drift < 0)
+        for (f, i), (target, _) in zip(group, group[1:]):
+            candidate = ((target - f) // drift, i, target)
+            if best is None or candidate < best:
+                best = candidate
+
+    if best is None:
+        return None, None
+    return best[2], best[0] + 1
+
+
+def iter_changes(source, chunk_size: int=1 << 16):  # -> Iterator[int]
+    # source is a filename, a file-like object (file, pipe, ...) or an iterable of changes
+    if isinstance(source, str):
+        with open(source) as f:
+            yield from iter_changes(f, chunk_size)
+        return
+    if not hasattr(source, 'read'):
+        for l in source:
+            yield int(l)
+        return
+
+    leftover = ''
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
             break
-        freq_history.add(freq)
-    if 0 == loops:
-        print('Stabilised at freq %d' % freq)
-    #if 0 == loops%1000000:
-    #	print('loops=%d freq=%d history_len=%d' % (loops, freq, len(freq_history)))
-    loops += 1
-
-print('First duplicate freq %d (in %d loops)' % (final_freq, loops))
\ No newline at end of file
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode()
+        lines = (leftover + chunk).split('\n')
+        leftover = lines.pop()
+        for l in lines:
+            if l.strip():
+                yield int(l)
+    if leftover.strip():
+        yield int(leftover)
+
+
+class FrequencyHistory(object):
+    """Set of visited frequencies stored as one bit per frequency around an offset"""
+
+    def __init__(self):
+        self.offset = 0
+        self.bits = bytearray()
+        self.size = 0
+
+    def _grow(self, freq: int):
+        low = min(self.offset, freq - freq % 8)
+        high = max(self.offset + 8 * len(self.bits), freq + 1)
+        # keep some slack in both directions to avoid copying on every new extreme
+        slack = max(8 * len(self.bits), 1024)
+        low -= slack // 2
+        low -= low % 8
+        high += slack // 2
+        bits = bytearray((high - low + 7) // 8)
+        start = (self.offset - low) // 8
+        bits[start:start + len(self.bits)] = self.bits
+        self.offset = low
+        self.bits = bits
+
+    def add(self, freq: int):  # -> bool
+        # returns whether freq had already been visited
+        index = freq - self.offset
+        if index < 0 or index >= 8 * len(self.bits):
+            self._grow(freq)
+            index = freq - self.offset
+        mask = 1 << (index & 7)
+        if self.bits[index >> 3] & mask:
+            return True
+        self.bits[index >> 3] |= mask
+        self.size += 1
+        return False
+
+    def __contains__(self, freq: int):
+        index = freq - self.offset
+        if index < 0 or index >= 8 * len(self.bits):
+            return False
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+class FrequencyEngine(object):
+    """Streaming first duplicate search
+
+    The first pass is consumed as the changes are read so the source can be a pipe (in
+    as many consume calls as needed), the changes are kept in a compact array to replay
+    the following passes.
+    """
+
+    def __init__(self):
+        self.freq = 0
+        self.changes = array('q')
+        self.history = FrequencyHistory()
+        self.loops = 0
+        self.final_freq = None
+        self.stabilised = None
+        self.finished = False
+
+    @property
+    def nbytes(self):
+        return self.history.nbytes + self.changes.itemsize * len(self.changes)
+
+    def __str__(self):
+        return 'loops=%d freq=%d history_len=%d memory=%d bytes' % (
+            self.loops, self.freq, len(self.history), self.nbytes,
+        )
+
+    def _visit(self, change: int):  # -> bool
+        self.freq += change
+        if self.history.add(self.freq):
+            self.final_freq = self.freq
+            return True
+        return False
+
+    def consume(self, changes: Iterable[int]):  # -> FrequencyEngine
+        # Still reads the whole first pass after a duplicate to know the stabilised frequency
+        if self.finished:
+            raise ValueError('The first pass is already finished')
+        total = self.stabilised or 0
+        for l in changes:
+            self.changes.append(l)
+            if self.final_freq is None:
+                self._visit(l)
+            total += l
+        self.stabilised = total
+        return self
+
+    def finish(self):  # -> FrequencyEngine
+        # the first pass is complete: no more changes can be consumed
+        if self.stabilised is None:
+            raise ValueError('No changes consumed')
+        if not self.finished:
+            self.finished = True
+            self.loops += 1
+        return self
+
+    def run(self, max_loops: int=None, report_every: int=None):  # -> Tuple[int, int]
+        # (None, None) when the frequencies never repeat, like first_duplicate
+        self.finish()
+        if not self.changes:
+            return None, None
+        if self.final_freq is None and self.stabilised != 0 and (None, None) == first_duplicate(self.changes):
+            return None, None
+        while self.final_freq is None:
+            if max_loops is not None and self.loops >= max_loops:
+                return None, self.loops
+            for l in self.changes:
+                if self._visit(l):
+                    break
+            self.loops += 1
+            if report_every and 0 == self.loops % report_every:
+                print(str(self))
+        return self.final_freq, self.loops
+
+    @classmethod
+    def from_source(cls, source, chunk_size: int=1 << 16):  # -> FrequencyEngine
+        return cls().consume(iter_changes(source, chunk_size))
+
+
+BatchResult = namedtuple('BatchResult', ['name', 'stabilised', 'first_duplicate', 'loops'])
+
+
+def _batch_chunk(change_lists: List[List[int]]):  # -> List[Tuple[int, int, int]]
+    # Vectorised version of first_duplicate over many lists at once:
+    # every list is concatenated and identified by its index in `lists`.
+    n_lists = len(change_lists)
+    lengths = np.array([len(c) for c in change_lists], dtype=np.int64)
+    rv = [(0, None, None)] * n_lists
+    if 0 == lengths.sum():
+        return rv
+
+    values = np.concatenate([np.asarray(c, dtype=np.int64) for c in change_lists])
+    starts = np.cumsum(lengths) - lengths
+    lists = np.repeat(np.arange(n_lists), lengths)
+    index = np.arange(len(values)) - np.repeat(starts, lengths)
+    total = np.cumsum(values)
+    prefix = total - np.repeat(np.concatenate(([0], total))[starts], lengths)
+
+    non_empty = lengths > 0
+    drift = np.zeros(n_lists, dtype=np.int64)
+    drift[non_empty] = prefix[(starts + lengths - 1)[non_empty]]
+
+    # -1 means not found yet, otherwise the position of the duplicate in the stream
+    found = np.full(n_lists, -1, dtype=np.int64)
+    freq = np.zeros(n_lists, dtype=np.int64)
+
+    # duplicates during the first pass
+    order = np.lexsort((index, prefix, lists))
+    s_lists = lists[order]
+    same = (s_lists[1:] == s_lists[:-1]) & (prefix[order][1:] == prefix[order][:-1])
+    if same.any():
+        dup_time = np.full(n_lists, np.iinfo(np.int64).max)
+        np.minimum.at(dup_time, s_lists[1:][same], index[order][1:][same])
+        has_dup = dup_time != np.iinfo(np.int64).max
+        found[has_dup] = dup_time[has_dup]
+        freq[has_dup] = prefix[starts[has_dup] + dup_time[has_dup]]
+
+    # no drift: the first frequency of the second pass is a duplicate
+    no_drift = (found < 0) & (0 == drift) & non_empty
+    found[no_drift] = lengths[no_drift]
+    freq[no_drift] = prefix[starts[no_drift]]
+
+    # drift: group by residue and pick the closest reachable frequency
+    pending = (found < 0) & (drift != 0)
+    selected = np.nonzero(pending[lists])[0]
+    if len(selected) > 1:
+        s_lists = lists[selected]
+        s_prefix = prefix[selected]
+        residue = s_prefix % np.abs(drift[s_lists])
+        order = np.lexsort((s_prefix, residue, s_lists))
+        a, b = order[:-1], order[1:]
+        same = (s_lists[a] == s_lists[b]) & (residue[a] == residue[b])
+        a, b = a[same], b[same]
+        positive = drift[s_lists[a]] > 0
+        src = np.where(positive, a, b)
+        tgt = np.where(positive, b, a)
+        src_lists = s_lists[src]
+        loops = (s_prefix[tgt] - s_prefix[src]) // drift[src_lists]
+        time = loops * lengths[src_lists] + index[selected][src]
+        order = np.lexsort((time, src_lists))
+        first_lists, first = np.unique(src_lists[order], return_index=True)
+        found[first_lists] = time[order][first]
+        freq[first_lists] = s_prefix[tgt][order][first]
+
+    for i in range(n_lists):
+        if found[i] >= 0:
+            rv[i] = (int(drift[i]), int(freq[i]), int(found[i] // lengths[i]) + 1)
+        else:
+            rv[i] = (int(drift[i]), None, None)
+    return rv
+
+
+def batch(sources, processes: int=None, chunk_size: int=1000):  # -> List[BatchResult]
+    """Compute the stabilised frequency and first duplicate of many change lists
+
+    :param sources: a directory of files, a dict of name to changes or a list of changes
+    :param processes: number of workers, 1 to stay in this process (None uses every core)
+    :param chunk_size: number of lists given to a worker at once
+    """
+    if isinstance(sources, str):
+        names = sorted(os.listdir(sources))
+        change_lists = [load(os.path.join(sources, n)) for n in names]
+    elif isinstance(sources, dict):
+        names = list(sources.keys())
+        change_lists = list(sources.values())
+    else:
+        change_lists = list(sources)
+        names = list(range(len(change_lists)))
+
+    chunks = [change_lists[i:i + chunk_size] for i in range(0, len(change_lists), chunk_size)]
+    if 1 == processes or len(chunks) <= 1:
+        partials = [_batch_chunk(c) for c in chunks]
+    else:
+        with Pool(processes) as pool:
+            partials = pool.map(_batch_chunk, chunks)
+
+    rv = []
+    for name, values in zip(names, (v for p in partials for v in p)):
+        rv.append(BatchResult(name, *values))
+    return rv
+
+
+if '__main__' == __name__:
+
+    changes = load('input.txt')
+
+    print('Stabilised at freq %d' % stabilised(changes))
+
+    final_freq, loops = first_duplicate(changes)
+    print('First duplicate freq %d (in %d loops)' % (final_freq, loops))
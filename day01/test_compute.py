@@ -0,0 +1,111 @@
+import io
+
+import pytest
+
+from day01.compute import FrequencyEngine, FrequencyHistory, batch, first_duplicate, first_duplicate_loop, stabilised
+
+
+@pytest.mark.parametrize('changes, expected', (
+    ([+1, -2, +3, +1], (2, 2)),
+    ([+1, -1], (1, 2)),
+    ([+3, +3, +4, -2, -4], (10, 2)),
+    ([-6, +3, +8, +5, -6], (5, 3)),
+    ([+7, +7, -2, -7, -4], (14, 3)),
+))
+def test_first_duplicate(changes, expected):
+    rv = first_duplicate_loop(changes)
+    assert expected == rv, 'loop got %r' % (rv, )
+    rv = first_duplicate(changes)
+    assert expected == rv, 'got %r' % (rv, )
+
+
+def test_stabilised():
+    assert 3 == stabilised([+1, +1, +1])
+    assert -6 == stabilised([-1, -2, -3])
+
+
+def test_never_repeats():
+    assert (None, None) == first_duplicate([+1, +1])
+
+
+@pytest.mark.parametrize('changes, expected', (
+    ([+1, -2, +3, +1], (2, 2)),
+    ([+3, +3, +4, -2, -4], (10, 2)),
+    ([-6, +3, +8, +5, -6], (5, 3)),
+    ([+7, +7, -2, -7, -4], (14, 3)),
+))
+def test_engine(changes, expected):
+    engine = FrequencyEngine.from_source(changes)
+    assert sum(changes) == engine.stabilised
+    rv = engine.run()
+    assert expected == rv, 'got %r' % (rv, )
+
+
+def test_engine_stream():
+    stream = io.StringIO('+1\n-2\n+3\n+1\n')
+    engine = FrequencyEngine.from_source(stream, chunk_size=3)
+    assert [1, -2, 3, 1] == list(engine.changes)
+    assert (2, 2) == engine.run()
+
+
+@pytest.mark.parametrize('changes', ([+1, -1, +5, +2], [+3, +3, +4, -2, -4], [-6, +3, +8, +5, -6]))
+def test_engine_chunks(changes):
+    expected = FrequencyEngine.from_source(changes).run()
+    engine = FrequencyEngine()
+    for i in range(0, len(changes), 2):
+        engine.consume(changes[i:i + 2])
+    assert sum(changes) == engine.stabilised
+    rv = engine.run()
+    assert expected == rv, 'got %r' % (rv, )
+    with pytest.raises(ValueError):
+        engine.consume([1])
+
+
+def test_engine_max_loops():
+    engine = FrequencyEngine.from_source([+7, +7, -2, -7, -4])
+    assert (None, 2) == engine.run(max_loops=2)
+    assert (14, 3) == engine.run()
+
+
+@pytest.mark.parametrize('changes', ([], [+1, +1], [+3, -1]))
+def test_engine_no_duplicate(changes):
+    assert (None, None) == first_duplicate(changes)
+    rv = FrequencyEngine.from_source(changes).run()
+    assert (None, None) == rv, 'got %r' % (rv, )
+
+
+def test_history():
+    history = FrequencyHistory()
+    for f in (0, -3, 5000, -12000):
+        assert not history.add(f)
+    for f in (0, -3, 5000, -12000):
+        assert f in history
+        assert history.add(f)
+    assert 1 not in history
+    assert 4 == len(history)
+
+
+def test_batch():
+    change_lists = [
+        [+1, -2, +3, +1],
+        [+1, -1],
+        [+3, +3, +4, -2, -4],
+        [-6, +3, +8, +5, -6],
+        [+7, +7, -2, -7, -4],
+        [+1, +1],
+        [],
+    ]
+    expected = [
+        (2, 2),
+        (1, 2),
+        (10, 2),
+        (5, 3),
+        (14, 3),
+        (None, None),
+        (None, None),
+    ]
+    for processes in (1, 2):
+        rv = batch(change_lists, processes=processes, chunk_size=3)
+        assert list(range(len(change_lists))) == [r.name for r in rv]
+        assert [sum(c) for c in change_lists] == [r.stabilised for r in rv]
+        assert expected == [(r.first_duplicate, r.loops) for r in rv], 'got %r' % rv
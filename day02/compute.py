@@ -1,8 +1,16 @@
 """
 Answer to https://adventofcode.com/2018/day/2
 """
-from collections import defaultdict
-from typing import List
+import bisect
+import mmap
+import os
+import pickle
+import tempfile
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 
 class ID(object):
@@ -37,8 +45,213 @@ class ID(object):
         return rv[2] * rv[3]
 
     @classmethod
-    def compare(cls, elements: List):
+    def matrix_from_buffer(cls, data, offset: int=0, block_rows: int=1 << 14):  # -> Tuple[np.ndarray, np.ndarray]
+        # Returns the non empty lines of data as rows of a uint8 matrix (shorter words are
+        # padded with 0) and the position of each line in the buffer (shifted by offset)
+        buf = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buf == ord('\n'))
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [len(buf)]))
+        while True:
+            # trailing whitespace (\r, spaces) is not part of the word
+            trailing = (ends > starts) & np.isin(buf[np.maximum(ends - 1, 0)], (ord('\r'), ord(' ')))
+            if not trailing.any():
+                break
+            ends[trailing] -= 1
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+
+        widths = ends - starts
+        width = int(widths.max()) if len(widths) else 0
+        columns = np.arange(width)
+        matrix = np.zeros((len(starts), width), dtype=np.uint8)
+        # gather the letters by blocks of rows to bound the (rows, width) positions
+        for start in range(0, len(starts), block_rows):
+            stop = start + block_rows
+            positions = np.minimum(starts[start:stop, None] + columns, len(buf) - 1)
+            matrix[start:stop] = np.where(columns < widths[start:stop, None], buf[positions], 0)
+        return matrix, starts + offset
+
+    @classmethod
+    def matrix_from_file(cls, filename: str):  # -> np.ndarray
+        with open(filename, 'rb') as f:
+            matrix, _ = cls.matrix_from_buffer(f.read())
+
+        print('Loaded %d elements from %s' % (len(matrix), filename))
+        return matrix
+
+    @classmethod
+    def letter_counts(cls, matrix: np.ndarray, block_rows: int=1 << 14):  # -> np.ndarray
+        # Per row histogram of the 26 letters (anything else, like the padding, is not
+        # counted) in the smallest integer type, computed on blocks of rows
+        n_rows, width = matrix.shape
+        counts = np.zeros((n_rows, 26), dtype=np.uint8 if width < 256 else np.uint32)
+        for start in range(0, n_rows, block_rows):
+            block = matrix[start:start + block_rows]
+            letters = block.astype(np.int16) - ord('a')
+            rows = np.broadcast_to(np.arange(len(block), dtype=np.int32)[:, None] * 26, block.shape)
+            keep = (letters >= 0) & (letters < 26)
+            block_counts = np.bincount((rows + letters)[keep], minlength=len(block) * 26)
+            counts[start:start + len(block)] = block_counts.reshape(len(block), 26)
+        return counts
+
+    @classmethod
+    def twos_threes(cls, matrix: np.ndarray, block_rows: int=1 << 14):  # -> Tuple[int, int]
+        # number of rows with a letter exactly twice and exactly three times
+        twos = threes = 0
+        for start in range(0, matrix.shape[0], block_rows):
+            counts = cls.letter_counts(matrix[start:start + block_rows], block_rows)
+            twos += int((counts == 2).any(axis=1).sum())
+            threes += int((counts == 3).any(axis=1).sum())
+        return twos, threes
+
+    @classmethod
+    def checksum_matrix(cls, matrix: np.ndarray):  # -> int
+        twos, threes = cls.twos_threes(matrix)
+        return twos * threes
+
+    @classmethod
+    def masked_keys(cls, matrix: np.ndarray):  # -> np.ndarray
+        # 64 bits hash of every row with one position masked out, shape (rows, width),
+        # rows differing by one letter share a key (collisions are possible)
+        rows, width = matrix.shape
+        powers = np.full(width, 1000003, dtype=np.uint64) ** np.arange(width, dtype=np.uint64)
+        weighted = matrix.astype(np.uint64) * powers
+        full = weighted.sum(axis=1, dtype=np.uint64)
+        lengths = (matrix != 0).sum(axis=1).astype(np.uint64)
+        salt = np.arange(1, width + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (full[:, None] - weighted) ^ salt ^ (lengths[:, None] * np.uint64(0xC2B2AE3D27D4EB4F))
+
+    @classmethod
+    def _checksum_shard(cls, args):  # -> Tuple[int, int, np.ndarray]
+        # with a directory, the masked keys of the shard and the (32 bits) row of their lines
+        # are saved there sorted by partition (key % n_parts) along with the offset of each
+        # row, the partitions' bounds are returned
+        filename, start, end, directory, shard, n_parts = args
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                matrix, offsets = cls.matrix_from_buffer(mm[start:end], start)
+        twos, threes = cls.twos_threes(matrix)
+        if directory is None:
+            return twos, threes, None
+        keys = cls.masked_keys(matrix).ravel()
+        parts = keys % np.uint64(n_parts)
+        order = np.argsort(parts, kind='stable')
+        np.save(os.path.join(directory, '%d-keys.npy' % shard), keys[order])
+        np.save(os.path.join(directory, '%d-rows.npy' % shard), (order // matrix.shape[1]).astype(np.uint32))
+        np.save(os.path.join(directory, '%d-offsets.npy' % shard), offsets)
+        return twos, threes, np.searchsorted(parts[order], np.arange(n_parts + 1))
+
+    @classmethod
+    def _partition_candidates(cls, args):  # -> np.ndarray
+        # offsets of the lines sharing a key with another line within one partition
+        directory, ranges = args
+        keys, offsets = [np.zeros(0, dtype=np.uint64)], [np.zeros(0, dtype=np.int64)]
+        for shard, low, high in ranges:
+            if low < high:
+                keys.append(np.load(os.path.join(directory, '%d-keys.npy' % shard), mmap_mode='r')[low:high])
+                rows = np.load(os.path.join(directory, '%d-rows.npy' % shard), mmap_mode='r')[low:high]
+                offsets.append(np.load(os.path.join(directory, '%d-offsets.npy' % shard), mmap_mode='r')[rows])
+        keys, offsets = np.concatenate(keys), np.concatenate(offsets)
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        return np.unique(offsets[counts[inverse] > 1])
+
+    @classmethod
+    def shards(cls, filename: str, n_shards: int):  # -> List[Tuple[int, int]]
+        # splits the file in about n_shards byte ranges ending on a newline
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if 0 == size:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                bounds = [0]
+                for n in range(1, n_shards):
+                    pos = mm.find(b'\n', max(size * n // n_shards, bounds[-1]))
+                    if pos < 0:
+                        break
+                    if pos + 1 > bounds[-1]:
+                        bounds.append(pos + 1)
+                if bounds[-1] < size:
+                    bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    @classmethod
+    def _map(cls, function, jobs: List, processes: int=None):  # -> List
+        if 1 == processes or len(jobs) <= 1:
+            return [function(j) for j in jobs]
+        with Pool(processes) as pool:
+            return pool.map(function, jobs)
+
+    @classmethod
+    def checksum_parallel(cls, filename: str, processes: int=None, n_shards: int=None, fused: bool=False,
+                          shard_size: int=1 << 20):
+        """Checksum of a file computed on newline aligned shards of the memory mapped file
+
+        :param n_shards: minimum number of shards (default 4 per worker)
+        :param shard_size: maximum number of bytes of a shard (unless a line is longer)
+        :param fused: also return the byte offsets of the lines that may be one letter
+            away from another line (see ID.from_offsets). The workers save their masked
+            keys partitioned by hash in a temporary directory then each partition is
+            reduced by a worker, so only the candidates come back to this process.
+        :return: checksum, or (checksum, candidate offsets) when fused
+        """
+        if n_shards is None:
+            n_shards = 4 * (processes or os.cpu_count() or 1)
+        n_shards = max(n_shards, -(-os.path.getsize(filename) // shard_size))
+        ranges = cls.shards(filename, n_shards)
+
+        if not fused:
+            partials = cls._map(cls._checksum_shard, [(filename, start, end, None, n, 0)
+                                                      for n, (start, end) in enumerate(ranges)], processes)
+            return sum(p[0] for p in partials) * sum(p[1] for p in partials)
+
+        # about as many partitions as shards so a partition is about the size of a shard's keys
+        n_parts = max(len(ranges), 1)
+        with tempfile.TemporaryDirectory() as directory:
+            partials = cls._map(cls._checksum_shard, [(filename, start, end, directory, n, n_parts)
+                                                      for n, (start, end) in enumerate(ranges)], processes)
+            jobs = [
+                (directory, [(n, p[2][part], p[2][part + 1]) for n, p in enumerate(partials)])
+                for part in range(n_parts)
+            ]
+            candidates = cls._map(cls._partition_candidates, jobs, processes)
+
+        checksum = sum(p[0] for p in partials) * sum(p[1] for p in partials)
+        return checksum, np.unique(np.concatenate(candidates + [np.zeros(0, dtype=np.int64)]))
+
+    @classmethod
+    def from_offsets(cls, filename: str, offsets: List[int]):  # -> List[ID]
+        elements = []
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start in offsets:
+                    end = mm.find(b'\n', int(start))
+                    if end < 0:
+                        end = len(mm)
+                    elements.append(cls(mm[int(start):end].decode().rstrip()))
+        return elements
+
+    @classmethod
+    def compare(cls, elements: List, indexed: bool=False):
         # returns the common letters
+        if indexed:
+            # the first pair in (i, j) order, as similar_pairs would give it
+            buckets, keys = cls._masked_buckets(elements)
+            for i, word_keys in enumerate(keys):
+                best = None
+                for pos, key in enumerate(word_keys):
+                    bucket = buckets[key]
+                    for j in bucket[bisect.bisect_right(bucket, i):]:
+                        if best is not None and j >= best[0]:
+                            break
+                        if cls._one_apart(elements[i].word, elements[j].word, pos):
+                            best = (j, pos)
+                            break
+                if best is not None:
+                    word = elements[i].word
+                    return word[:best[1]] + word[best[1] + 1:]
+            return None
+
         for i, _id in enumerate(elements):
             for other in elements[i:]:
                 common = _id.common(other)
@@ -47,6 +260,51 @@ class ID(object):
                 if 1 == num_diff:
                     return common
 
+    @classmethod
+    def _masked_buckets(cls, elements: List):  # -> Tuple[Dict[Tuple[int, int, int], List[int]], List[List[Tuple]]]
+        # Polynomial hash of every word, the hash with one position masked out is then
+        # obtained in O(1) (see masked_keys): returns the indexes of the words per
+        # (length, position, masked hash) and the keys of each word
+        modulo = (1 << 61) - 1
+        base = 1000003
+        powers = [1]
+        buckets = defaultdict(list)
+        keys = []
+        for i, _id in enumerate(elements):
+            word = _id.word
+            while len(powers) < len(word):
+                powers.append(powers[-1] * base % modulo)
+            full = sum(ord(c) * powers[k] for k, c in enumerate(word)) % modulo
+            word_keys = [(len(word), pos, (full - ord(c) * powers[pos]) % modulo) for pos, c in enumerate(word)]
+            for key in word_keys:
+                buckets[key].append(i)
+            keys.append(word_keys)
+        return buckets, keys
+
+    @staticmethod
+    def _one_apart(a: str, b: str, pos: int):  # -> bool
+        # a and b only differ at pos (guards against hash collisions)
+        return a[pos] != b[pos] and a[:pos] == b[:pos] and a[pos + 1:] == b[pos + 1:]
+
+    @classmethod
+    def similar_pairs(cls, elements: List):  # -> List[Tuple[ID, ID, str]]
+        # Every pair of IDs differing by exactly one letter as (first, second, common letters),
+        # in the order compare would find them. Words are hashed once per position with
+        # that position masked out so matching words land in the same bucket.
+        buckets, _ = cls._masked_buckets(elements)
+        pairs = []
+        for (_, pos, _), bucket in buckets.items():
+            for n, i in enumerate(bucket):
+                for j in bucket[n + 1:]:
+                    if cls._one_apart(elements[i].word, elements[j].word, pos):
+                        pairs.append((i, j, pos))
+
+        pairs.sort()
+        return [
+            (elements[i], elements[j], elements[i].word[:pos] + elements[i].word[pos + 1:])
+            for i, j, pos in pairs
+        ]
+
     def common(self, other):
         _common = ''
         # assumes len(other.word) == len(self.word)
@@ -57,12 +315,95 @@ class ID(object):
         return _common
 
 
+class SlotID(object):
+    """Lighter ID without per instance __dict__ nor defaultdict, works with ID's classmethods"""
+
+    __slots__ = ('word', 'reversed_letter_freq')
+
+    def __init__(self, word: str):
+        self.word = word
+        self.reversed_letter_freq = dict(Counter(Counter(word).values()))
+
+    from_file = classmethod(ID.from_file.__func__)
+    common = ID.common
+
+
+def hamming(a: str, b: str):  # -> int
+    assert len(a) == len(b), '%r vs %r' % (a, b)
+    return sum(1 for x, y in zip(a, b) if x != y)
+
+
+class SimilarityIndex(object):
+    """Finds the words within a Hamming distance of k of a query word
+
+    Words are split into k + 1 segments: two words with at most k differences
+    share at least one identical segment, so only words sharing a segment with
+    the query are compared with it.
+    """
+
+    def __init__(self, words: List[str], k: int=1):
+        self.k = k
+        self.words = list(words)
+        self.segments: Dict[Tuple[int, int, str], List[int]] = defaultdict(list)
+        for i, w in enumerate(self.words):
+            for n, segment in enumerate(self._split(w)):
+                self.segments[(len(w), n, segment)].append(i)
+        self.segments = dict(self.segments)
+
+    @classmethod
+    def from_ids(cls, elements: List[ID], k: int=1):  # -> SimilarityIndex
+        return cls([e.word for e in elements], k)
+
+    def _split(self, word: str):  # -> List[str]
+        parts = self.k + 1
+        bounds = [len(word) * n // parts for n in range(parts + 1)]
+        return [word[bounds[n]:bounds[n + 1]] for n in range(parts)]
+
+    def query(self, word: str, k: int=None):  # -> List[str]
+        # returns the indexed words (in inventory order) at most k letters away from word
+        if k is None:
+            k = self.k
+        if k > self.k:
+            raise ValueError('Index built for k=%d, cannot query k=%d' % (self.k, k))
+        candidates = set()
+        for n, segment in enumerate(self._split(word)):
+            candidates.update(self.segments.get((len(word), n, segment), ()))
+        return [
+            self.words[i]
+            for i in sorted(candidates)
+            if hamming(word, self.words[i]) <= k
+        ]
+
+    def query_many(self, words: List[str], k: int=None):  # -> List[List[str]]
+        cache = {}
+        rv = []
+        for w in words:
+            if w not in cache:
+                cache[w] = self.query(w, k)
+            rv.append(cache[w])
+        return rv
+
+    def save(self, filename: str):
+        with open(filename, 'wb') as f:
+            pickle.dump((self.k, self.words, self.segments), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename: str):  # -> SimilarityIndex
+        with open(filename, 'rb') as f:
+            k, words, segments = pickle.load(f)
+        rv = cls.__new__(cls)
+        rv.k = k
+        rv.words = words
+        rv.segments = segments
+        return rv
+
+
 if '__main__' == __name__:
 
     inventory = ID.from_file('input.txt')
 
-    checksum = ID.checksum(inventory)
+    checksum = ID.checksum_matrix(ID.matrix_from_file('input.txt'))
     print('Checksum is %d' % checksum)  # 3952
 
-    similar_words = ID.compare(inventory)
+    similar_words = ID.compare(inventory, indexed=True)
     print('Common letters are %s' % similar_words)  # vtnikorkulbfejvyznqgdxpaw
@@ -1,4 +1,9 @@
-from day02.compute import ID
+import random
+
+import numpy as np
+import pytest
+
+from day02.compute import ID, SimilarityIndex, SlotID, hamming
 
 
 def test_1():
@@ -15,3 +20,123 @@ def test_2():
     common = ID.compare(inventory)
     print('common=%r' % common)
     assert 'fgij' == common
+
+
+def test_indexed():
+    inventory = ID.from_file('test2.txt')
+    common = ID.compare(inventory, indexed=True)
+    assert 'fgij' == common, 'common=%r' % common
+
+
+def test_similar_pairs():
+    inventory = [ID(w) for w in ('abcd', 'abce', 'xbcd', 'abcd', 'wxyz')]
+    pairs = [(a.word, b.word, common) for a, b, common in ID.similar_pairs(inventory)]
+    assert [
+        ('abcd', 'abce', 'abc'),
+        ('abcd', 'xbcd', 'bcd'),
+        ('abce', 'abcd', 'abc'),
+        ('xbcd', 'abcd', 'bcd'),
+    ] == pairs, 'pairs=%r' % pairs
+    assert ID.compare(inventory) == ID.compare(inventory, indexed=True)
+
+    rng = random.Random(4)
+    for _ in range(50):
+        inventory = [ID(''.join(rng.choice('ab') for _ in range(4))) for _ in range(rng.randint(1, 12))]
+        expected = [
+            (i, j) for i, a in enumerate(inventory) for j, b in enumerate(inventory)
+            if i < j and 1 == sum(x != y for x, y in zip(a.word, b.word))
+        ]
+        pairs = ID.similar_pairs(inventory)
+        assert [(inventory[i], inventory[j]) for i, j in expected] == [(a, b) for a, b, _ in pairs]
+        assert ID.compare(inventory) == ID.compare(inventory, indexed=True)
+
+
+def test_similarity_index(tmp_path):
+    inventory = ID.from_file('test2.txt')
+    words = [i.word for i in inventory]
+    index = SimilarityIndex.from_ids(inventory, k=2)
+
+    for w in words + ['fghzz', 'zzzzz']:
+        for k in (0, 1, 2):
+            expected = [o for o in words if hamming(w, o) <= k]
+            rv = index.query(w, k)
+            assert expected == rv, '%s k=%d got %r' % (w, k, rv)
+
+    assert [['fghij', 'fguij'], []] == index.query_many(['fguij', 'zzzzz'], k=1)
+
+    filename = str(tmp_path / 'index.pickle')
+    index.save(filename)
+    loaded = SimilarityIndex.load(filename)
+    assert index.query_many(words) == loaded.query_many(words)
+
+
+@pytest.mark.parametrize('filename', ('test1.txt', 'test2.txt'))
+def test_checksum_matrix(filename):
+    matrix = ID.matrix_from_file(filename)
+    expected = ID.checksum(ID.from_file(filename))
+    assert expected == ID.checksum_matrix(matrix)
+
+
+def test_checksum_matrix_ragged(tmp_path):
+    filename = str(tmp_path / 'ragged.txt')
+    with open(filename, 'w') as f:
+        f.write('aab\nabbbcc\nxyz\nqq\n')
+    matrix = ID.matrix_from_file(filename)
+    assert (4, 6) == matrix.shape
+    assert 3 * 1 == ID.checksum_matrix(matrix)
+
+
+def test_letter_counts():
+    matrix, _ = ID.matrix_from_buffer(b'aab\nabbbcc\nxyz\nqq\n')
+    for block_rows in (1, 3, 100):
+        counts = ID.letter_counts(matrix, block_rows=block_rows)
+        assert (4, 26) == counts.shape
+        assert np.uint8 == counts.dtype
+        assert [2, 1, 0] == counts[0, :3].tolist()
+        assert [1, 3, 2] == counts[1, :3].tolist()
+        assert 2 == counts[3, ord('q') - ord('a')]
+        assert (3, 1) == ID.twos_threes(matrix, block_rows=block_rows)
+
+
+def test_slot_id():
+    inventory = SlotID.from_file('test1.txt')
+    assert isinstance(inventory[0], SlotID)
+    assert 12 == ID.checksum(inventory)
+
+    inventory = SlotID.from_file('test2.txt')
+    assert 'fgij' == ID.compare(inventory)
+
+
+@pytest.mark.parametrize('processes', (1, 2))
+def test_checksum_parallel(processes):
+    for filename, expected in (('test1.txt', 12), ('test2.txt', 0)):
+        for n_shards in (1, 3, 20):
+            rv = ID.checksum_parallel(filename, processes=processes, n_shards=n_shards)
+            assert expected == rv, '%s n_shards=%d got %d' % (filename, n_shards, rv)
+
+
+def test_checksum_parallel_fused():
+    checksum, candidates = ID.checksum_parallel('test2.txt', processes=1, n_shards=3, fused=True)
+    assert 0 == checksum
+    candidates = ID.from_offsets('test2.txt', candidates)
+    assert ['fghij', 'fguij'] == [c.word for c in candidates]
+    assert 'fgij' == ID.compare(candidates, indexed=True)
+
+
+@pytest.mark.parametrize('processes', (1, 2))
+def test_checksum_parallel_shard_size(tmp_path, processes):
+    rng = random.Random(7)
+    words = [''.join(rng.choice('abcdef') for _ in range(8)) for _ in range(300)]
+    words[250] = words[20][:3] + 'z' + words[20][4:]
+    filename = str(tmp_path / 'ids.txt')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(words) + '\n')
+
+    expected = ID.checksum_parallel(filename, processes=1, n_shards=1, fused=True)
+    checksum, candidates = ID.checksum_parallel(filename, processes=processes, n_shards=1, fused=True,
+                                                shard_size=100)
+    assert expected[0] == checksum
+    assert expected[1].tolist() == candidates.tolist()
+    assert ID.checksum(ID.from_file(filename)) == checksum
+    assert {9 * 20, 9 * 250} <= set(candidates.tolist())
+    assert checksum == ID.checksum_parallel(filename, processes=processes, shard_size=100)
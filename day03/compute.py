@@ -1,10 +1,16 @@
 """
 Answer to https://adventofcode.com/2018/day/3
 """
+import bisect
+import mmap
+import os
 import re
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool
 from typing import List
 
+import numpy as np
+
 
 Position = namedtuple('Position', ['x', 'y'])
 
@@ -41,52 +47,125 @@ class Rect(object):
         return 'Rect(%d,%d %dx%d)' % (self.left, self.top, self.width, self.height)
 
 
+# Columnar claims: one row per claim
+CLAIM_DTYPE = np.dtype([
+    ('id', np.int64),
+    ('left', np.int64),
+    ('top', np.int64),
+    ('width', np.int64),
+    ('height', np.int64),
+])
+
+
+def claims_array(shapes):  # -> np.ndarray
+    # accepts a list of Rect or an array of CLAIM_DTYPE
+    if isinstance(shapes, np.ndarray):
+        return shapes
+    return np.array([(s.id, s.left, s.top, s.width, s.height) for s in shapes], dtype=CLAIM_DTYPE)
+
+
+def load_claims(filename: str, use_mmap: bool=False, block_size: int=1 << 24):  # -> np.ndarray
+    # Every non digit byte is turned into a space so numpy can parse the numbers of
+    # a whole block at once, 5 numbers per claim: #id @ left,top: widthxheight
+    non_digits = bytes(c for c in range(256) if not ord('0') <= c <= ord('9'))
+    table = bytes.maketrans(non_digits, b' ' * len(non_digits))
+    numbers = []
+    with open(filename, 'rb') as f:
+        use_mmap = use_mmap and os.fstat(f.fileno()).st_size > 0
+        if use_mmap:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+        try:
+            start = 0
+            while start < len(data):
+                end = data.find(b'\n', min(start + block_size, len(data)))
+                end = len(data) if end < 0 else end + 1
+                block = data[start:end].translate(table)
+                numbers.append(np.fromstring(block, dtype=np.int64, sep=' '))
+                start = end
+        finally:
+            if use_mmap:
+                data.close()
+
+    numbers = np.concatenate(numbers + [np.zeros(0, dtype=np.int64)])
+    if len(numbers) % 5:
+        raise ValueError('Incorrectly formatted claims in %s' % filename)
+    return np.ascontiguousarray(numbers.reshape(-1, 5)).view(CLAIM_DTYPE).reshape(-1)
+
+
 class Raster(object):
 
-    def __init__(self, shapes: List[Rect], width: int, height: int):
+    def __init__(self, shapes, width: int, height: int):
+        # shapes is a list of Rect or an array of CLAIM_DTYPE (see load_claims)
         print('Creating raster of %dx%d' % (width, height))
         self.surface = None
         self.width = width
         self.height = height
 
-        self.shapes = shapes
-        self._populate(shapes)
+        self._shapes = None if isinstance(shapes, np.ndarray) else shapes
+        self._populate(claims_array(shapes))
 
-    def _populate(self, shapes: List[Rect]):
-        self.surface = []
-        for h in range(self.height):
-            self.surface.append(list())
-            for w in range(self.width):
-                self.surface[h].append(list())
-        for s in shapes:
-            for pos in s.positions():
-                if self.surface[pos.y][pos.x] is None:
-                    self.surface[pos.y][pos.x] = [s.id]
-                else:
-                    self.surface[pos.y][pos.x].append(s.id)
+    @property
+    def shapes(self):  # -> List[Rect]
+        # only created when asked for
+        if self._shapes is None:
+            self._shapes = [Rect(*row) for row in self.claims.tolist()]
+        return self._shapes
+
+    def _populate(self, claims: np.ndarray):
+        self.claims = claims
+        self.surface = self._paint(claims, dtype=np.int32)
+
+    def _paint(self, claims: np.ndarray, weights: np.ndarray=None, dtype=np.int32):  # -> np.ndarray
+        # 2D difference array: +w at the top left corner of each claim, -w right after its
+        # right and bottom edges and +w after the bottom right corner, the cumulative sums
+        # then give the total weight (1 by default) of the claims covering each square inch.
+        diff = np.zeros((self.height + 1, self.width + 1), dtype=dtype)
+        if len(claims):
+            lefts = claims['left']
+            tops = claims['top']
+            rights = lefts + claims['width']
+            bottoms = tops + claims['height']
+            w = 1 if weights is None else np.asarray(weights, dtype=dtype)
+            np.add.at(diff, (tops, lefts), w)
+            np.add.at(diff, (tops, rights), -w)
+            np.add.at(diff, (bottoms, lefts), -w)
+            np.add.at(diff, (bottoms, rights), w)
+        return diff.cumsum(axis=0).cumsum(axis=1)[:self.height, :self.width]
+
+    def _overlapped_cells(self, claims: np.ndarray):  # -> np.ndarray
+        # summed area table of the overlapping square inches: the number of overlapping
+        # square inches within a claim is then given by its 4 corners
+        table = np.zeros((self.height + 1, self.width + 1), dtype=np.int64)
+        table[1:, 1:] = (self.surface > 1).cumsum(axis=0).cumsum(axis=1)
+        lefts = claims['left']
+        tops = claims['top']
+        rights = lefts + claims['width']
+        bottoms = tops + claims['height']
+        return table[bottoms, rights] - table[tops, rights] - table[bottoms, lefts] + table[tops, lefts]
 
     def overlapping_surface(self):
-        surface = 0
-        for line in self.surface:
-            for col in line:
-                if len(col) > 1:
-                    surface += 1
-        return surface
+        return int((self.surface > 1).sum())
 
     def not_overlapping(self):
         assert self.surface is not None
-        ids = {shape.id for shape in self.shapes}
-        for line in self.surface:
-            for col in line:
-                if len(col) > 1:
-                    for id in col:
-                        if id in ids:
-                            ids.remove(id)
-        return list(ids)
+        return self.claims['id'][0 == self._overlapped_cells(self.claims)].tolist()
 
     @classmethod
-    def from_file(cls, filename: str):
+    def from_file(cls, filename: str, engine: str=None, bulk: bool=True, use_mmap: bool=False):
+        # engine is one of ENGINES, defaults to the class from_file is called on
+        # bulk parses every claim at once into an array (see load_claims), otherwise
+        # one Rect is created per line
+        if engine is not None:
+            cls = ENGINES[engine]
         print('Loading from %s' % filename)
+        if bulk:
+            claims = load_claims(filename, use_mmap=use_mmap)
+            raster_width = int((claims['left'] + claims['width']).max(initial=0))
+            raster_height = int((claims['top'] + claims['height']).max(initial=0))
+            return cls(claims, raster_width, raster_height)
+
         fmt = re.compile('#([0-9]*) @ ([0-9]*),([0-9]*): ([0-9]*)x([0-9]*)$')
         shapes = []
         raster_width = 0
@@ -106,6 +185,432 @@ class Raster(object):
         return cls(shapes, raster_width, raster_height)
 
 
+class LiveRaster(Raster):
+    """Raster accepting new claims and withdrawals
+
+    Besides the number of claims per square inch it keeps the sum of their ids (which is
+    the owner's id where a single claim is present) and, for every claim, the number of its
+    square inches shared with other claims. The ids of the claims overlapping no other
+    are kept sorted by the order of the claims. Updates cost O(claim area) and both
+    queries are answered from the maintained values.
+    """
+
+    def _populate(self, claims: np.ndarray):
+        shapes = self._shapes if self._shapes is not None else [Rect(*row) for row in claims.tolist()]
+        self._claims = {}
+        self._order = {}
+        for s in shapes:
+            if s.id in self._claims:
+                raise ValueError('Duplicate claim #%d' % s.id)
+            self._claims[s.id] = s
+            self._order[s.id] = len(self._order)
+        self._next_order = len(self._order)
+        self.width = max([self.width] + [s.right for s in shapes])
+        self.height = max([self.height] + [s.bottom for s in shapes])
+
+        self.surface = self._paint(claims, dtype=np.int32)
+        self.ids = self._paint(claims, weights=claims['id'], dtype=np.int64)
+        self._overlap = int((self.surface > 1).sum())
+        self._overlapped = dict(zip(claims['id'].tolist(), self._overlapped_cells(claims).tolist()))
+        # free claims' ids and orders, both sorted by order
+        self._free = [i for i, n in self._overlapped.items() if 0 == n]
+        self._free_orders = [self._order[i] for i in self._free]
+
+    @property
+    def shapes(self):
+        return list(self._claims.values())
+
+    @property
+    def claims(self):
+        return claims_array(self.shapes)
+
+    def _grow(self, width: int, height: int):
+        if width <= self.width and height <= self.height:
+            return
+        width = max(width, self.width)
+        height = max(height, self.height)
+        pad = ((0, height - self.height), (0, width - self.width))
+        self.surface = np.pad(self.surface, pad)
+        self.ids = np.pad(self.ids, pad)
+        self.width = width
+        self.height = height
+
+    def _set_free(self, id: int, free: bool):
+        order = self._order[id]
+        n = bisect.bisect_left(self._free_orders, order)
+        listed = n < len(self._free_orders) and order == self._free_orders[n]
+        if free and not listed:
+            self._free_orders.insert(n, order)
+            self._free.insert(n, id)
+        elif listed and not free:
+            del self._free_orders[n]
+            del self._free[n]
+
+    def _update_free(self, ids):
+        for i in ids:
+            self._set_free(i, 0 == self._overlapped[i])
+
+    def add_claim(self, rect: Rect):
+        if rect.id in self._claims:
+            raise ValueError('Duplicate claim #%d' % rect.id)
+        self._grow(rect.right, rect.bottom)
+        counts = self.surface[rect.top:rect.bottom, rect.left:rect.right]
+        ids = self.ids[rect.top:rect.bottom, rect.left:rect.right]
+
+        # square inches owned by a single claim become overlapped
+        owners, n = np.unique(ids[counts == 1], return_counts=True)
+        for owner, cells in zip(owners.tolist(), n.tolist()):
+            self._overlapped[owner] += cells
+        self._overlap += int(n.sum())
+
+        self._claims[rect.id] = rect
+        self._order[rect.id] = self._next_order
+        self._next_order += 1
+        self._overlapped[rect.id] = int((counts > 0).sum())
+        counts += 1
+        ids += rect.id
+        self._update_free(owners.tolist() + [rect.id])
+
+    def remove_claim(self, id: int):  # -> Rect
+        if id not in self._claims:
+            raise KeyError('No claim #%d' % id)
+        self._set_free(id, False)
+        rect = self._claims.pop(id)
+        del self._order[id]
+        del self._overlapped[id]
+        counts = self.surface[rect.top:rect.bottom, rect.left:rect.right]
+        ids = self.ids[rect.top:rect.bottom, rect.left:rect.right]
+        counts -= 1
+        ids -= id
+
+        # square inches left with a single claim are no longer overlapped
+        owners, n = np.unique(ids[counts == 1], return_counts=True)
+        for owner, cells in zip(owners.tolist(), n.tolist()):
+            self._overlapped[owner] -= cells
+        self._overlap -= int(n.sum())
+        self._update_free(owners.tolist())
+        return rect
+
+    def overlapping_surface(self):
+        return self._overlap
+
+    def not_overlapping(self):
+        return list(self._free)
+
+
+def _tiles_overlap(tiles):  # -> Tuple[int, Set[int]]
+    # tiles is a list of (size, full, claims) where full is the number of claims covering
+    # the whole tile (0 or 1) and claims the other ones as (id, left, top, right, bottom)
+    # clipped to the tile and relative to its top left corner
+    overlap = 0
+    overlapping = set()
+    for size, full, claims in tiles:
+        diff = np.zeros((size + 1, size + 1), dtype=np.int32)
+        for _, left, top, right, bottom in claims:
+            diff[top, left] += 1
+            diff[top, right] -= 1
+            diff[bottom, left] -= 1
+            diff[bottom, right] += 1
+        overlapped = diff.cumsum(axis=0).cumsum(axis=1)[:size, :size] + full > 1
+        overlap += int(overlapped.sum())
+        if full:
+            # the claim covering the whole tile overlaps every other one
+            overlapping.update(c[0] for c in claims)
+            continue
+        table = np.zeros((size + 1, size + 1), dtype=np.int64)
+        table[1:, 1:] = overlapped.cumsum(axis=0).cumsum(axis=1)
+        for id, left, top, right, bottom in claims:
+            if table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]:
+                overlapping.add(id)
+    return overlap, overlapping
+
+
+def _area_sums(values: np.ndarray):  # -> np.ndarray
+    # summed area table: sum of values[top:bottom, left:right] is
+    # table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.int32)
+    table[1:, 1:] = values
+    np.cumsum(table, axis=0, out=table)
+    np.cumsum(table, axis=1, out=table)
+    return table
+
+
+class TiledRaster(Raster):
+    """Raster split into tile_size x tile_size tiles
+
+    The tiles a claim fully covers are only counted, on a grid compressed to the bounds
+    of these tiles (so nothing is stored for untouched tiles), the claim is clipped to
+    its border tiles only. Tiles fully covered by several claims are entirely
+    overlapped and a tile touched by a single claim cannot overlap: only the other tiles
+    are painted, each with its own small counter array. They are processed in batches by
+    a pool of processes, the per tile results are then summed.
+    """
+
+    def __init__(self, shapes: List[Rect], width: int, height: int,
+                 tile_size: int=256, processes: int=None, tiles_per_job: int=64):
+        self.tile_size = tile_size
+        self.processes = processes
+        self.tiles_per_job = tiles_per_job
+        super().__init__(shapes, width, height)
+
+    def _populate(self, claims: np.ndarray):
+        self.claims = claims
+        self.surface = None
+        size = self.tile_size
+
+        interiors = []  # (id, first tile x, first tile y, last tile x + 1, last tile y + 1)
+        borders = defaultdict(list)
+        for id, left, top, width, height in claims.tolist():
+            if 0 == width * height:
+                continue
+            right, bottom = left + width, top + height
+            # tiles fully covered by the claim
+            ix0, iy0 = -(-left // size), -(-top // size)
+            ix1, iy1 = right // size, bottom // size
+            if ix0 < ix1 and iy0 < iy1:
+                interiors.append((id, ix0, iy0, ix1, iy1))
+            else:
+                ix0 = ix1 = iy0 = iy1 = 0
+
+            first_x, last_x = left // size, (right - 1) // size
+            for ty in range(top // size, (bottom - 1) // size + 1):
+                if iy0 <= ty < iy1:
+                    # only the tiles left and right of the whole ones
+                    xs = list(range(first_x, ix0)) + list(range(ix1, last_x + 1))
+                else:
+                    xs = range(first_x, last_x + 1)
+                for tx in xs:
+                    x, y = tx * size, ty * size
+                    borders[(tx, ty)].append((
+                        id,
+                        max(left, x) - x,
+                        max(top, y) - y,
+                        min(right, x + size) - x,
+                        min(bottom, y + size) - y,
+                    ))
+
+        # Number of claims covering whole tiles (and the sum of their ids, which is the
+        # claim's id where a single one is present) on the tile grid compressed to the
+        # boundaries of the claims' whole tiles: each cell is a block of tiles
+        xs = sorted({v for i in interiors for v in (i[1], i[3])})
+        ys = sorted({v for i in interiors for v in (i[2], i[4])})
+        x_index = {v: n for n, v in enumerate(xs)}
+        y_index = {v: n for n, v in enumerate(ys)}
+        full = np.zeros((max(len(ys), 1), max(len(xs), 1)), dtype=np.int32)
+        owners = np.zeros(full.shape, dtype=np.int64)
+        cells = []
+        for id, ix0, iy0, ix1, iy1 in interiors:
+            cx0, cy0, cx1, cy1 = x_index[ix0], y_index[iy0], x_index[ix1], y_index[iy1]
+            cells.append((id, cx0, cy0, cx1, cy1))
+            for values, w in ((full, 1), (owners, id)):
+                values[cy0, cx0] += w
+                values[cy0, cx1] -= w
+                values[cy1, cx0] -= w
+                values[cy1, cx1] += w
+        for values in (full, owners):
+            np.cumsum(values, axis=0, out=values)
+            np.cumsum(values, axis=1, out=values)
+        full, owners = full[:-1, :-1], owners[:-1, :-1]
+        areas = np.outer(np.diff(ys), np.diff(xs)) if interiors else np.zeros((0, 0), dtype=np.int64)
+
+        def whole(tx: int, ty: int):  # -> Tuple[int, int]
+            # (number of claims covering the whole tile, sum of their ids)
+            cx, cy = bisect.bisect_right(xs, tx) - 1, bisect.bisect_right(ys, ty) - 1
+            if 0 <= cx < full.shape[1] and 0 <= cy < full.shape[0]:
+                return int(full[cy, cx]), int(owners[cy, cx])
+            return 0, 0
+
+        self._overlap = int(areas[full > 1].sum()) * size * size
+        self.tiles = int(areas[full > 0].sum())
+        self._overlapping_ids = set()
+        # claims sharing a whole tile
+        crowded = _area_sums(full > 1)
+        for id, cx0, cy0, cx1, cy1 in cells:
+            if crowded[cy1, cx1] - crowded[cy0, cx1] - crowded[cy1, cx0] + crowded[cy0, cx0]:
+                self._overlapping_ids.add(id)
+
+        busy = []
+        for (tx, ty), clipped in borders.items():
+            count, owner = whole(tx, ty)
+            self.tiles += 0 == count
+            if count > 1:
+                # already counted as entirely overlapped
+                self._overlapping_ids.update(c[0] for c in clipped)
+            elif 1 == count:
+                # the claim covering the whole tile overlaps the others
+                self._overlapping_ids.add(owner)
+                busy.append((size, 1, clipped))
+            elif len(clipped) > 1:
+                busy.append((size, 0, clipped))
+        self.painted_tiles = len(busy)
+
+        jobs = [busy[i:i + self.tiles_per_job] for i in range(0, len(busy), self.tiles_per_job)]
+        if 1 == self.processes or len(jobs) <= 1:
+            partials = [_tiles_overlap(j) for j in jobs]
+        else:
+            with Pool(self.processes) as pool:
+                partials = pool.map(_tiles_overlap, jobs)
+
+        self._overlap += sum(p[0] for p in partials)
+        for p in partials:
+            self._overlapping_ids.update(p[1])
+
+    def overlapping_surface(self):
+        return self._overlap
+
+    def not_overlapping(self):
+        return [id for id in self.claims['id'].tolist() if id not in self._overlapping_ids]
+
+
+class _SweepTree(object):
+    """Segment tree over the elementary intervals between the sorted ys
+
+    Ranges are only ever added then removed (no push down needed), each node keeps:
+    - count: number of rectangles covering the whole node
+    - len1/len2: length covered by at least 1/2 rectangles within the node
+    - cover: maximum number of rectangles covering a point of the node
+    - stamp/max_stamp: latest time a rectangle covered the whole node/any part of it
+    """
+
+    def __init__(self, ys: List[int]):
+        self.ys = ys
+        self.n = len(ys) - 1
+        size = 4 * max(self.n, 1)
+        self.count = [0] * size
+        self.len1 = [0] * size
+        self.len2 = [0] * size
+        self.cover = [0] * size
+        self.stamp = [0] * size
+        self.max_stamp = [0] * size
+
+    def _pull(self, node: int, lo: int, hi: int):
+        leaf = 1 == hi - lo
+        full = self.ys[hi] - self.ys[lo]
+        left, right = 2 * node, 2 * node + 1
+        if self.count[node] >= 2:
+            self.len1[node] = full
+            self.len2[node] = full
+        elif 1 == self.count[node]:
+            self.len1[node] = full
+            self.len2[node] = 0 if leaf else self.len1[left] + self.len1[right]
+        elif leaf:
+            self.len1[node] = 0
+            self.len2[node] = 0
+        else:
+            self.len1[node] = self.len1[left] + self.len1[right]
+            self.len2[node] = self.len2[left] + self.len2[right]
+        self.cover[node] = self.count[node] + (0 if leaf else max(self.cover[left], self.cover[right]))
+        self.max_stamp[node] = max(
+            self.stamp[node],
+            0 if leaf else max(self.max_stamp[left], self.max_stamp[right]),
+        )
+
+    def update(self, l: int, r: int, delta: int, stamp: int=0, node: int=1, lo: int=0, hi: int=None):
+        if hi is None:
+            hi = self.n
+        if r <= lo or hi <= l:
+            return
+        if l <= lo and hi <= r:
+            self.count[node] += delta
+            self.stamp[node] = max(self.stamp[node], stamp)
+        else:
+            mid = (lo + hi) // 2
+            self.update(l, r, delta, stamp, 2 * node, lo, mid)
+            self.update(l, r, delta, stamp, 2 * node + 1, mid, hi)
+        self._pull(node, lo, hi)
+
+    def query(self, l: int, r: int, node: int=1, lo: int=0, hi: int=None):  # -> Tuple[int, int]
+        # returns (max cover, max stamp) over [l, r)
+        if hi is None:
+            hi = self.n
+        if r <= lo or hi <= l:
+            return 0, 0
+        if l <= lo and hi <= r:
+            return self.cover[node], self.max_stamp[node]
+        mid = (lo + hi) // 2
+        left = self.query(l, r, 2 * node, lo, mid)
+        right = self.query(l, r, 2 * node + 1, mid, hi)
+        return (
+            self.count[node] + max(left[0], right[0]),
+            max(self.stamp[node], left[1], right[1]),
+        )
+
+    @property
+    def overlapping_length(self):
+        return self.len2[1]
+
+
+class SweepRaster(Raster):
+    """Same results as Raster from a sweep line over the claims' vertical edges
+
+    The cost only depends on the number of claims (O(n log n)), not on the fabric size.
+    """
+
+    def _populate(self, claims: np.ndarray):
+        self.claims = claims
+        self.surface = None
+        self._overlap = None
+        self._overlapping_ids = None
+
+    def _sweep(self):
+        if self._overlap is not None:
+            return
+        claims = self.claims[(self.claims['width'] > 0) & (self.claims['height'] > 0)]
+        ids = claims['id'].tolist()
+        lefts = claims['left'].tolist()
+        rights = (claims['left'] + claims['width']).tolist()
+        tops = claims['top'].tolist()
+        bottoms = (claims['top'] + claims['height']).tolist()
+        ys = sorted(set(tops) | set(bottoms))
+        y_index = {y: i for i, y in enumerate(ys)}
+        tree = _SweepTree(ys)
+
+        # at the same x, claims ending there are removed before new ones are added
+        events = sorted(
+            [(x, 1, i) for i, x in enumerate(lefts)] +
+            [(x, 0, i) for i, x in enumerate(rights)]
+        )
+        overlap = 0
+        overlapping = set()
+        added_at = {}
+        prev_x = None
+        for time, (x, is_add, i) in enumerate(events, 1):
+            if prev_x is not None:
+                overlap += tree.overlapping_length * (x - prev_x)
+            prev_x = x
+            l, r = y_index[tops[i]], y_index[bottoms[i]]
+            if is_add:
+                # overlaps a claim already there
+                if tree.query(l, r)[0] > 0:
+                    overlapping.add(i)
+                added_at[i] = time
+                tree.update(l, r, 1, time)
+            else:
+                tree.update(l, r, -1)
+                # overlapped by a claim added since this one
+                if tree.query(l, r)[1] > added_at[i]:
+                    overlapping.add(i)
+
+        self._overlap = overlap
+        self._overlapping_ids = {ids[i] for i in overlapping}
+
+    def overlapping_surface(self):
+        self._sweep()
+        return self._overlap
+
+    def not_overlapping(self):
+        self._sweep()
+        return [id for id in self.claims['id'].tolist() if id not in self._overlapping_ids]
+
+
+ENGINES = {
+    'raster': Raster,
+    'sweep': SweepRaster,
+    'live': LiveRaster,
+    'tiled': TiledRaster,
+}
+
+
 if '__main__' == __name__:
     raster = Raster.from_file('input.txt')
     overlap = raster.overlapping_surface()  # 101469
@@ -1,4 +1,10 @@
-from day03.compute import Raster, Rect, Position
+import random
+
+import pytest
+
+from day03.compute import (
+    ENGINES, Position, Raster, Rect, SweepRaster, TiledRaster, claims_array, load_claims,
+)
 
 
 def test_loading():
@@ -39,3 +45,134 @@ def test_not_overlapping():
     raster = Raster.from_file('test1.txt')
     not_overlap = raster.not_overlapping()
     assert [3] == not_overlap, 'not_overlap=%r' % not_overlap
+
+
+def test_surface():
+    raster = Raster.from_file('test1.txt')
+    expected = [[0] * raster.width for _ in range(raster.height)]
+    for s in raster.shapes:
+        for pos in s.positions():
+            expected[pos.y][pos.x] += 1
+    assert expected == raster.surface.tolist()
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES.keys()))
+def test_engines(engine):
+    raster = Raster.from_file('test1.txt', engine=engine)
+    assert isinstance(raster, ENGINES[engine])
+    assert 4 == raster.overlapping_surface()
+    assert [3] == raster.not_overlapping()
+
+
+def test_sweep_edges():
+    # touching claims do not overlap, nested and crossing claims do
+    shapes = [
+        Rect(1, 0, 0, 2, 2),
+        Rect(2, 2, 0, 2, 2),
+        Rect(3, 0, 2, 4, 1),
+        Rect(4, 10, 10, 5, 5),
+        Rect(5, 11, 11, 1, 1),
+        Rect(6, 20, 0, 1, 10),
+        Rect(7, 15, 5, 10, 1),
+    ]
+    expected = Raster(shapes, 25, 15)
+    raster = SweepRaster(shapes, 25, 15)
+    assert 2 == expected.overlapping_surface()
+    assert expected.overlapping_surface() == raster.overlapping_surface()
+    assert [1, 2, 3] == raster.not_overlapping()
+
+
+def test_live_raster():
+    raster = Raster.from_file('test1.txt', engine='live')
+    assert 4 == raster.overlapping_surface()
+    assert [3] == raster.not_overlapping()
+
+    raster.add_claim(Rect(4, 6, 6, 2, 2))
+    assert (8, 8) == (raster.width, raster.height)
+    assert 5 == raster.overlapping_surface()
+    assert [] == raster.not_overlapping()
+
+    raster.remove_claim(1)
+    assert 1 == raster.overlapping_surface()
+    assert [2] == raster.not_overlapping()
+
+    raster.remove_claim(4)
+    assert 0 == raster.overlapping_surface()
+    assert [2, 3] == raster.not_overlapping()
+    assert [2, 3] == [s.id for s in raster.shapes]
+
+    with pytest.raises(ValueError):
+        raster.add_claim(Rect(2, 0, 0, 1, 1))
+    with pytest.raises(KeyError):
+        raster.remove_claim(1)
+
+    # a claim added again comes after the existing ones
+    raster.add_claim(Rect(1, 20, 20, 1, 1))
+    raster.add_claim(Rect(5, 3, 1, 1, 1))
+    assert [3, 1] == raster.not_overlapping()
+    raster.remove_claim(5)
+    assert [2, 3, 1] == raster.not_overlapping()
+
+
+@pytest.mark.parametrize('tile_size', (1, 2, 3, 256))
+@pytest.mark.parametrize('processes', (1, 2))
+def test_tiled_raster(tile_size, processes):
+    expected = Raster.from_file('test1.txt')
+    raster = TiledRaster(expected.shapes, expected.width, expected.height,
+                         tile_size=tile_size, processes=processes, tiles_per_job=2)
+    assert 4 == raster.overlapping_surface()
+    assert [3] == raster.not_overlapping()
+
+
+def test_tiled_raster_full_tiles():
+    shapes = [
+        Rect(1, 0, 0, 8, 8),
+        Rect(2, 4, 4, 8, 8),
+        Rect(3, 20, 20, 4, 4),
+    ]
+    raster = TiledRaster(shapes, 24, 24, tile_size=4, processes=1)
+    assert 16 == raster.overlapping_surface()
+    assert [3] == raster.not_overlapping()
+    # the only tile touched by 2 claims is covered by both
+    assert 0 == raster.painted_tiles
+    assert 4 + 4 - 1 + 1 == raster.tiles
+
+
+@pytest.mark.parametrize('tile_size', (2, 3, 4))
+def test_tiled_raster_random(tile_size):
+    rng = random.Random(tile_size)
+    for _ in range(20):
+        shapes = [
+            Rect(i, rng.randint(0, 20), rng.randint(0, 20), rng.randint(0, 12), rng.randint(0, 12))
+            for i in range(1, rng.randint(2, 12))
+        ]
+        expected = Raster(shapes, 32, 32)
+        raster = TiledRaster(shapes, 32, 32, tile_size=tile_size, processes=1, tiles_per_job=3)
+        assert expected.overlapping_surface() == raster.overlapping_surface()
+        assert expected.not_overlapping() == raster.not_overlapping()
+
+
+@pytest.mark.parametrize('use_mmap', (False, True))
+def test_load_claims(use_mmap):
+    claims = load_claims('test1.txt', use_mmap=use_mmap, block_size=8)
+    assert [
+        (1, 1, 3, 4, 4),
+        (2, 3, 1, 4, 4),
+        (3, 5, 5, 2, 2),
+    ] == claims.tolist()
+    assert [1, 2, 3] == claims['id'].tolist()
+
+
+def test_load_claims_empty(tmp_path):
+    filename = str(tmp_path / 'empty.txt')
+    open(filename, 'w').close()
+    assert 0 == len(load_claims(filename, use_mmap=True))
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES.keys()))
+def test_bulk_loading(engine):
+    raster = Raster.from_file('test1.txt', engine=engine)
+    lines = Raster.from_file('test1.txt', engine=engine, bulk=False)
+    assert (lines.width, lines.height) == (raster.width, raster.height)
+    assert claims_array(lines.shapes).tolist() == raster.claims.tolist()
+    assert [str(s) for s in lines.shapes] == [str(s) for s in raster.shapes]
@@ -1,30 +1,86 @@
 """
 Answer to https://adventofcode.com/2018/day/4
 """
+import bisect
+import heapq
 import re
+import sys
+import tempfile
+import time
+from array import array
 from datetime import date, datetime, timedelta
 from enum import IntEnum
-from typing import Dict, List
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
 
 
 Status = IntEnum('Status', ['Begin', 'Awake', 'Asleep'])
 
+MINUTES_PER_DAY = 24 * 60
+
+
+def minute_histogram(starts: np.ndarray, lengths: np.ndarray):  # -> np.ndarray
+    """Number of intervals covering each minute of the day
+
+    :param starts: minute of the day (0 to 1439) each interval starts at
+    :param lengths: length in minutes of each interval, less than a day
+    """
+    # difference array over 2 days so intervals going past midnight do not need splitting
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    diff = np.zeros(2 * MINUTES_PER_DAY + 1, dtype=np.int64)
+    np.add.at(diff, starts, 1)
+    np.add.at(diff, starts + lengths, -1)
+    return _fold(diff)
+
+
+def _fold(diff: np.ndarray):  # -> np.ndarray
+    # histogram of the day from a difference array over 2 days
+    covered = diff.cumsum(dtype=np.int64)[:2 * MINUTES_PER_DAY]
+    return covered[:MINUTES_PER_DAY] + covered[MINUTES_PER_DAY:]
+
+
+def to_minutes(when: datetime):  # -> int
+    # minutes since 0001-01-01 00:00, so minutes % MINUTES_PER_DAY is the minute of the day
+    return when.toordinal() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+
+def from_minutes(minutes: int):  # -> datetime
+    return datetime.fromordinal(minutes // MINUTES_PER_DAY) + timedelta(minutes=minutes % MINUTES_PER_DAY)
+
 
 class GuardState(object):
 
     time_fmt = '%Y-%m-%d %H:%M'
     line_fmt = re.compile( '\[(.*)\] ([\w]*) (.*)$')
 
+    # days since 0001-01-01 of the 'YYYY-MM-DD' already parsed by from_str
+    _days: Dict[str, int] = {}
+
     def __init__(self, when: datetime, id: int, status: Status):
         self.id = id
-        self.when = when
+        self.minute = to_minutes(when)
         self.status = status
 
+    @classmethod
+    def from_minutes(cls, minute: int, id: int, status: Status):  # -> GuardState
+        rv = cls.__new__(cls)
+        rv.id = id
+        rv.minute = minute
+        rv.status = status
+        return rv
+
+    @property
+    def when(self):  # -> datetime
+        return from_minutes(self.minute)
+
     def __str__(self):
         return '[%s] #%r %s' % (self.when.strftime(self.time_fmt), self.id, self.status.name)
 
     def __eq__(self, other):
-        return self.id == other.id and self.when == other.when and self.status == other.status
+        return self.id == other.id and self.minute == other.minute and self.status == other.status
 
     def __ne__(self, other):
         return not self == other
@@ -38,7 +94,35 @@ class GuardState(object):
         return Status.Asleep == self.status
 
     @classmethod
-    def from_str(cls, string):  # -> GuardState
+    def _from_fixed_width(cls, string):  # -> Optional[Tuple[int, int, Status]]
+        # [YYYY-MM-DD HH:MM] action, None when string does not follow that layout
+        if len(string) < 24 or '[' != string[0] or '] ' != string[17:19]:
+            return None
+        day = cls._days.get(string[1:11])
+        if day is None:
+            day = date(int(string[1:5]), int(string[6:8]), int(string[9:11])).toordinal()
+            cls._days[string[1:11]] = day
+        minute = day * MINUTES_PER_DAY + int(string[12:14]) * 60 + int(string[15:17])
+        action = string[19:24]
+        if 'Guard' == action:
+            return minute, int(string[26:].split(' ', 1)[0]), Status.Begin
+        elif 'wakes' == action:
+            return minute, None, Status.Awake
+        elif 'falls' == action:
+            return minute, None, Status.Asleep
+        return None
+
+    @classmethod
+    def from_str(cls, string, fast: bool=True):  # -> GuardState
+        return cls.from_minutes(*cls.parse(string, fast))
+
+    @classmethod
+    def parse(cls, string, fast: bool=True):  # -> Tuple[int, int, Status]
+        # (minute, id, status) of a log line without creating a GuardState
+        if fast:
+            rv = cls._from_fixed_width(string)
+            if rv is not None:
+                return rv
         fmt = cls.line_fmt.search(string)
         if fmt is None:
             raise ValueError('Incorrectly formatted string: %r' % string)
@@ -55,18 +139,99 @@ class GuardState(object):
             status = Status.Asleep
         else:
             raise ValueError('Unexpected action %s' % action)
-        return cls(when, id, status)
+        return to_minutes(when), id, status
+
+
+class EventStore(object):
+    """Events stored as parallel arrays of minutes, guard ids (-1 when unknown) and statuses
+
+    GuardState objects are only created when an event is accessed by index or iterated on.
+    """
+
+    def __init__(self, minutes: Iterable[int]=(), ids: Iterable[int]=(), statuses: Iterable[int]=()):
+        self.minutes = array('q', minutes)
+        self.ids = array('i', ids)
+        self.statuses = array('b', statuses)
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]):  # -> EventStore
+        # parses the lines and sorts the events by time, events at the same minute keep
+        # the order of the lines
+        rv = cls()
+        for l in lines:
+            if not l.strip():
+                continue
+            minute, id, status = GuardState.parse(l.rstrip())
+            rv.append(minute, id, status)
+        order = np.argsort(np.frombuffer(rv.minutes, dtype=np.int64), kind='stable')
+        rv.minutes = array('q', np.frombuffer(rv.minutes, dtype=np.int64)[order].tobytes())
+        rv.ids = array('i', np.frombuffer(rv.ids, dtype=np.int32)[order].tobytes())
+        rv.statuses = array('b', np.frombuffer(rv.statuses, dtype=np.int8)[order].tobytes())
+        return rv
+
+    def fill_ids(self):
+        # events without id belong to the guard of the last shift which began
+        ids = np.frombuffer(self.ids, dtype=np.int32).copy()
+        if len(ids) and ids[0] < 0:
+            raise ValueError('First entry %s does not have an ID' % str(self[0]))
+        known = np.where(ids >= 0, np.arange(len(ids)), 0)
+        self.ids = array('i', ids[np.maximum.accumulate(known)].tobytes())
+
+    def append(self, minute: int, id: int, status: Status):
+        self.insert(len(self.minutes), minute, id, status)
+
+    def insert(self, position: int, minute: int, id: int, status: Status):
+        self.minutes.insert(position, minute)
+        self.ids.insert(position, -1 if id is None else id)
+        self.statuses.insert(position, int(status))
+
+    def bisect_right(self, minute: int):  # -> int
+        return bisect.bisect_right(self.minutes, minute)
+
+    def events(self):  # -> Iterator[Tuple[int, int, int]]
+        # (minute, id, status) without creating GuardState objects
+        for minute, id, status in zip(self.minutes, self.ids, self.statuses):
+            yield minute, None if id < 0 else id, status
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.minutes, self.ids, self.statuses))
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def __getitem__(self, i):  # -> GuardState
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        id = self.ids[i]
+        return GuardState.from_minutes(self.minutes[i], None if id < 0 else id, Status(self.statuses[i]))
+
+    def __iter__(self):  # -> Iterator[GuardState]
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, EventStore):
+            return (self.minutes, self.ids, self.statuses) == (other.minutes, other.ids, other.statuses)
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
 
 
 class GuardInfo(object):
 
     class MinDetails(object):
 
-        def __init__(self, minute: int, values: List[date]):
+        def __init__(self, minute: int, values: List[date]=None, count: int=None):
+            # values (the dates asleep on that minute) are only kept on demand
             self.minute = minute
             self.values = values
+            self.count = count
 
         def __str__(self):
+            if self.values is None:
+                return '%d->(%d)' % (self.minute, self.length)
             return '%d->[%s](%d)' % (
                 self.minute,
                 ', '.join([d.strftime('%Y-%m-%d') for d in self.values]),
@@ -75,23 +240,46 @@ class GuardInfo(object):
 
         @property
         def length(self):
+            if self.values is None:
+                return self.count
             return len(self.values)
 
-    def __init__(self, data: List=None, asleep: int=0, by_minutes: List=None):
-        self.id = data[0].id if data else None
+    def __init__(self, data: List=None, asleep: int=0, by_minutes: List=None, histogram: np.ndarray=None,
+                 id: int=None, first: int=None):
+        self.id = data[0].id if data else id
         self.data = data
+        # minute of the first event of the guard
+        self.first = data[0].minute if data else first
         self.asleep = asleep
+        # number of days asleep for each minute of the midnight hour
+        self.histogram = histogram
         self.by_minutes = by_minutes if by_minutes is not None else list()
 
+    def set_histogram(self, histogram: np.ndarray, dates: Dict[int, List[date]]=None):
+        self.histogram = histogram
+        minutes = np.flatnonzero(histogram).tolist()
+        # most slept minutes first, earliest first on ties
+        minutes.sort(key=lambda m: -histogram[m])
+        self.by_minutes = [
+            GuardInfo.MinDetails(m, dates[m] if dates is not None else None, int(histogram[m]))
+            for m in minutes
+        ]
+
     @property
     def worst_minute(self):
+        if self.histogram is not None:
+            if self.histogram.any():
+                return int(self.histogram.argmax())
+            return None
         if self.by_minutes:
             return self.by_minutes[0].minute
         return None
 
     @property
     def worst_length(self):
-        if self.by_minutes:
+        if self.histogram is not None and self.histogram.any():
+            return int(self.histogram.max())
+        if self.histogram is None and self.by_minutes:
             return self.by_minutes[0].length
         print('W: No data for %s' % str(self))
         return 0
@@ -104,93 +292,631 @@ class GuardInfo(object):
         )
 
 
+class SleepAggregator(object):
+    """Per guard sleep totals and midnight hour histograms from a stream of events
+
+    Events (minute, id, status) must be given sorted by time, a missing id (None) is the
+    id of the last guard who began a shift.
+
+    With partial=True the events can be a shard of a longer log (covering its own time
+    range): the events before the first shift of the shard are kept aside in its piece
+    along with the state of its last guard. Partial aggregates merge in any order and
+    grouping, the pieces are only stitched together by resolve once every shard is in.
+    """
+
+    def __init__(self, partial: bool=False):
+        self.partial = partial
+        self.last_id = None
+        self.count = 0
+        self.first = None
+        self.last = None
+        # events (minute, status) before the first known guard (partial only)
+        self.head: List[Tuple[int, Status]] = []
+        self._asleep: Dict[int, int] = {}
+        # difference arrays over 2 days of the intervals asleep added to the aggregate
+        # (a fixed size per guard whatever the length of the log) and whole day
+        # histograms of the aggregates merged into it (see histogram)
+        self._diffs: Dict[int, np.ndarray] = {}
+        self._histograms: Dict[int, np.ndarray] = {}
+        self._first: Dict[int, Tuple[int, Status]] = {}
+        self._previous: Dict[int, Tuple[int, Status]] = {}
+        # pieces of merged aggregates, None until merged
+        self._pieces = None
+
+    def _close(self, id: int, previous: Tuple[int, Status], minute: int, status: Status):
+        # accounts for the time between previous and the next event of the guard
+        if Status.Asleep != previous[1]:
+            return
+        # the time of the day between the 2 events, the day is irrelevant
+        time_diff = (minute - previous[0]) % MINUTES_PER_DAY
+        # If the time delta is 23h the last info is not from today's shift
+        assert time_diff < 23 * 60, 'Unexpected guard still asleep at the end of the shift %s (diff=%dmin prev=%s)' % (
+            str(GuardState.from_minutes(minute, id, Status(status))),
+            time_diff,
+            str(GuardState.from_minutes(previous[0], id, Status(previous[1]))),
+        )
+        self._asleep[id] += time_diff
+        diff = self._diffs.get(id)
+        if diff is None:
+            diff = self._diffs[id] = np.zeros(2 * MINUTES_PER_DAY + 1, dtype=np.int32)
+        start = previous[0] % MINUTES_PER_DAY
+        diff[start] += 1
+        diff[start + time_diff] -= 1
+
+    def add(self, minute: int, id: int, status: Status):  # -> int
+        # returns the id of the guard the event belongs to (None when not known yet)
+        if self._pieces is not None:
+            raise ValueError('Cannot add events to merged aggregates')
+        if self.first is None:
+            self.first = minute
+        self.last = minute
+        self.count += 1
+        if id is None:
+            if self.last_id is None:
+                if self.partial:
+                    self.head.append((minute, status))
+                    return None
+                raise ValueError('First entry %s does not have an ID' % str(
+                    GuardState.from_minutes(minute, id, Status(status))))
+            id = self.last_id
+        else:
+            self.last_id = id
+
+        previous = self._previous.get(id)
+        if previous is None:
+            assert Status.Asleep != status, 'Assuming a guard starts duty awake, got %s' % (
+                str(GuardState.from_minutes(minute, id, Status(status))))
+            self._asleep[id] = 0
+            self._first[id] = (minute, status)
+        else:
+            self._close(id, previous, minute, status)
+        self._previous[id] = (minute, status)
+        return id
+
+    @property
+    def guards_asleep(self):  # -> Dict[int, int]
+        return self._asleep
+
+    @property
+    def pieces(self):  # -> List[Tuple[int, List[Tuple[int, Status]], int, Tuple[int, Status]]]
+        # (first minute, head events, last guard, last guard's last event) of each shard
+        if self._pieces is not None:
+            return self._pieces
+        if not self.count:
+            return []
+        tail = self._previous[self.last_id] if self.last_id is not None else None
+        return [(self.first, self.head, self.last_id, tail)]
+
+    def update(self, events: Iterable[Tuple[int, int, Status]]):  # -> SleepAggregator
+        for minute, id, status in events:
+            self.add(minute, id, status)
+        return self
+
+    def histogram(self, id: int, hour_only: bool=True):  # -> np.ndarray
+        # number of days asleep at each minute of the midnight hour (or of the day)
+        day = _fold(self._diffs[id]) if id in self._diffs else np.zeros(MINUTES_PER_DAY, dtype=np.int64)
+        if id in self._histograms:
+            day += self._histograms[id]
+        return day[:60] if hour_only else day
+
+    def guards(self):  # -> Dict[int, GuardInfo]
+        # by order of first appearance
+        if self.partial:
+            return self.resolve().guards()
+        rv = {}
+        for id in sorted(self._asleep, key=lambda i: self._first[i][0]):
+            rv[id] = GuardInfo(id=id, asleep=self._asleep[id], first=self._first[id][0])
+            rv[id].set_histogram(self.histogram(id))
+        return rv
+
+    def merge(self, other):  # -> SleepAggregator
+        rv = SleepAggregator(partial=True)
+        rv._pieces = sorted(self.pieces + other.pieces, key=lambda p: p[0])
+        rv.count = self.count + other.count
+        firsts = [a.first for a in (self, other) if a.first is not None]
+        rv.first = min(firsts) if firsts else None
+        lasts = [a.last for a in (self, other) if a.last is not None]
+        rv.last = max(lasts) if lasts else None
+        for a in (self, other):
+            for id, asleep in a._asleep.items():
+                if id in rv._asleep:
+                    rv._asleep[id] += asleep
+                    rv._histograms[id] += a.histogram(id, hour_only=False)
+                    rv._first[id] = min(rv._first[id], a._first[id])
+                    rv._previous[id] = max(rv._previous[id], a._previous[id])
+                else:
+                    rv._asleep[id] = asleep
+                    rv._histograms[id] = a.histogram(id, hour_only=False)
+                    rv._first[id] = a._first[id]
+                    rv._previous[id] = a._previous[id]
+        return rv
+
+    @classmethod
+    def reduce(cls, partials: List):  # -> SleepAggregator
+        # merges pairs of aggregates until a single one is left
+        if not partials:
+            return cls(partial=True)
+        while len(partials) > 1:
+            merged = [a.merge(b) for a, b in zip(partials[::2], partials[1::2])]
+            if len(partials) % 2:
+                merged.append(partials[-1])
+            partials = merged
+        return partials[0]
+
+    def resolve(self):  # -> SleepAggregator
+        # gives the events before the first shift of each piece to the last guard of the
+        # piece before it
+        rv = SleepAggregator.from_dict(self.to_dict())
+        rv.partial = False
+        rv._pieces = None
+        rv.head = []
+        guard = None
+        for _, head, last_id, tail in self.pieces:
+            for minute, status in head:
+                if guard is None:
+                    raise ValueError('First entry %s does not have an ID' % str(
+                        GuardState.from_minutes(minute, None, status)))
+                rv._close(guard[0], guard[1], minute, status)
+                guard = (guard[0], (minute, status))
+            if last_id is not None:
+                guard = (last_id, tail)
+        rv.last_id = guard[0] if guard is not None else None
+        return rv
+
+    def to_dict(self):  # -> Dict
+        # plain (JSON compatible) representation, histograms cover the whole day
+        return {
+            'partial': self.partial,
+            'count': self.count,
+            'first': self.first,
+            'last': self.last,
+            'pieces': [
+                [first, [[m, int(s)] for m, s in head], last_id, None if tail is None else [tail[0], int(tail[1])]]
+                for first, head, last_id, tail in self.pieces
+            ],
+            'guards': [
+                {
+                    'id': id,
+                    'asleep': asleep,
+                    'histogram': self.histogram(id, hour_only=False).tolist(),
+                    'first': [self._first[id][0], int(self._first[id][1])],
+                    'previous': [self._previous[id][0], int(self._previous[id][1])],
+                }
+                for id, asleep in self._asleep.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, values: Dict):  # -> SleepAggregator
+        # always gives merged aggregates: no event can be added
+        rv = cls(partial=values['partial'])
+        rv.count = values['count']
+        rv.first = values['first']
+        rv.last = values['last']
+        rv._pieces = [
+            (first, [(m, Status(s)) for m, s in head], last_id, None if tail is None else (tail[0], Status(tail[1])))
+            for first, head, last_id, tail in values['pieces']
+        ]
+        for g in values['guards']:
+            id = g['id']
+            rv._asleep[id] = g['asleep']
+            rv._histograms[id] = np.array(g['histogram'], dtype=np.int64)
+            rv._first[id] = (g['first'][0], Status(g['first'][1]))
+            rv._previous[id] = (g['previous'][0], Status(g['previous'][1]))
+        return rv
+
+
+def _shard_aggregate(args):  # -> Dict
+    filename, run_size = args
+    with open(filename) as f:
+        return SleepAggregator(partial=True).update(external_sort(f, run_size)).to_dict()
+
+
+def aggregate_shards(filenames: List[str], processes: int=None, run_size: int=1000000):  # -> SleepAggregator
+    """Aggregates each log shard in a pool of processes then merges the partial results
+
+    Each shard may be unordered but must cover its own time range, a shift can start in a
+    shard and end in the next one.
+    """
+    jobs = [(f, run_size) for f in filenames]
+    if 1 == processes or len(jobs) <= 1:
+        partials = [_shard_aggregate(j) for j in jobs]
+    else:
+        with Pool(processes) as pool:
+            partials = pool.map(_shard_aggregate, jobs)
+    return SleepAggregator.reduce([SleepAggregator.from_dict(p) for p in partials])
+
+
+def _write_run(events: List[Tuple[int, int, int, int]]):  # -> TemporaryFile
+    run = tempfile.TemporaryFile()
+    array('q', [v for e in sorted(events) for v in e]).tofile(run)
+    run.seek(0)
+    return run
+
+
+def _read_run(run, block_size: int):  # -> Iterator[Tuple[int, int, int, int]]
+    while True:
+        block = array('q')
+        try:
+            block.fromfile(run, 4 * block_size)
+        except EOFError:
+            # last (partial) block
+            pass
+        if not block:
+            break
+        for i in range(0, len(block), 4):
+            yield tuple(block[i:i + 4])
+    run.close()
+
+
+def external_sort(lines: Iterable[str], run_size: int=1000000, block_size: int=4096):
+    # -> Iterator[Tuple[int, int, Status]]
+    """Parses and sorts log lines by time using sorted runs of at most run_size events on disk
+
+    Yields (minute, id, status) with a None id when the line does not name the guard,
+    events at the same minute keep the order of the lines.
+    """
+    runs = []
+    events = []
+    for position, l in enumerate(lines):
+        if not l.strip():
+            continue
+        minute, id, status = GuardState.parse(l.rstrip())
+        events.append((minute, position, -1 if id is None else id, int(status)))
+        if len(events) >= run_size:
+            runs.append(_write_run(events))
+            events = []
+    events.sort()
+
+    merged = heapq.merge(*[_read_run(r, block_size) for r in runs], iter(events))
+    for minute, _, id, status in merged:
+        yield minute, None if -1 == id else id, Status(status)
+
+
+class ShiftIndex(object):
+    """Midnight hour sleep of every guard as one 60 bits mask per day (bit m: asleep at 00:m)
+
+    Per guard the days are sorted and come with prefix sums of the minutes asleep and of
+    the days asleep at each minute, so a query over a date range only costs a bisection
+    per guard rather than a walk through the events.
+    """
+
+    def __init__(self):
+        self.days: Dict[int, array] = {}
+        self.masks: Dict[int, List[int]] = {}
+        self._totals: Dict[int, np.ndarray] = {}
+        self._counts: Dict[int, np.ndarray] = {}
+
+    @classmethod
+    def from_schedule(cls, schedule):  # -> ShiftIndex
+        rv = cls()
+        for id, events in schedule.guard_events().items():
+            rv.set_guard(id, events)
+        return rv
+
+    def set_guard(self, id: int, events: EventStore):
+        # (re)indexes a guard from its events sorted by time
+        masks: Dict[int, int] = {}
+        previous = None
+        for minute, _, status in events.events():
+            if previous is not None and Status.Asleep == previous[1]:
+                start, end = previous[0], minute
+                # the midnight hour of each day the interval goes through
+                for day in range(start // MINUTES_PER_DAY, (end - 1) // MINUTES_PER_DAY + 1):
+                    low = max(start, day * MINUTES_PER_DAY)
+                    high = min(end, day * MINUTES_PER_DAY + 60)
+                    if low < high:
+                        bits = ((1 << (high - low)) - 1) << (low - day * MINUTES_PER_DAY)
+                        masks[day] = masks.get(day, 0) | bits
+            previous = (minute, status)
+
+        days = sorted(masks)
+        self.days[id] = array('q', days)
+        self.masks[id] = [masks[d] for d in days]
+        bits = (np.array(self.masks[id], dtype=np.uint64).reshape(-1, 1) >> np.arange(60, dtype=np.uint64)) & 1
+        counts = np.zeros((len(days) + 1, 60), dtype=np.int64)
+        counts[1:] = bits.astype(np.int64).cumsum(axis=0)
+        self._counts[id] = counts
+        self._totals[id] = counts.sum(axis=1)
+
+    def remove_guard(self, id: int):
+        for values in (self.days, self.masks, self._totals, self._counts):
+            values.pop(id, None)
+
+    def _range(self, id: int, start: date=None, end: date=None):  # -> Tuple[int, int]
+        # indexes of the guard's days between start and end (included)
+        days = self.days[id]
+        low = 0 if start is None else bisect.bisect_left(days, start.toordinal())
+        high = len(days) if end is None else bisect.bisect_right(days, end.toordinal())
+        return low, max(low, high)
+
+    def asleep(self, id: int, start: date=None, end: date=None):  # -> int
+        low, high = self._range(id, start, end)
+        return int(self._totals[id][high] - self._totals[id][low])
+
+    def minute_counts(self, id: int, start: date=None, end: date=None):  # -> np.ndarray
+        # number of days asleep at each minute of the midnight hour
+        low, high = self._range(id, start, end)
+        return self._counts[id][high] - self._counts[id][low]
+
+    def sleepiest_guards(self, k: int=1, start: date=None, end: date=None):  # -> List[Tuple[int, int]]
+        # the k (id, minutes asleep) with the most minutes asleep between start and end
+        return heapq.nlargest(
+            k,
+            ((id, self.asleep(id, start, end)) for id in self.days),
+            key=lambda v: v[1],
+        )
+
+    def top_guards_by_minute(self, minute: int, k: int=1, start: date=None, end: date=None):
+        # -> List[Tuple[int, int]]
+        # the k (id, days asleep) most often asleep at 00:minute between start and end
+        return heapq.nlargest(
+            k,
+            ((id, int(self.minute_counts(id, start, end)[minute])) for id in self.days),
+            key=lambda v: v[1],
+        )
+
+    def sleepiest_minute(self, id: int, start: date=None, end: date=None):  # -> Tuple[int, int]
+        # (minute, days asleep) of the minute the guard was most often asleep, (None, 0) when never
+        counts = self.minute_counts(id, start, end)
+        if not counts.any():
+            return None, 0
+        minute = int(counts.argmax())
+        return minute, int(counts[minute])
+
+
 class Schedule(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, keep_dates: bool=False, run_size: int=None):
+        # keep_dates keeps the dates a guard was asleep on each minute (see GuardInfo.MinDetails)
+        # run_size streams the file through an external sort of at most run_size events per
+        # run on disk: guards are then aggregated on the fly and no event is kept (data is None)
+        self.keep_dates = keep_dates
+        self._by_guard = None
+        self._guard_events: Dict[int, EventStore] = None
+        # guards whose GuardInfo is out of date, and the cached by_guard results
+        self._dirty = set()
+        self._sorted = {}
+        self._shift_index = None
+        self._index_dirty = set()
+        if run_size is not None:
+            self._stream(filename, run_size)
+            return
 
-        data = []
         print('Loading from %s' % filename)
         with open(filename) as f:
-            for l in f.readlines():
-                data.append(GuardState.from_str(l.rstrip()))
-
-        self.data = sorted(data, key=lambda a: a.when)
-        self._by_guard = None
-        if not data:
+            self.data = EventStore.from_lines(f)
+        if not self.data:
             raise ValueError('No data')
-        if self.data[0].id is None:
-            raise ValueError('First entry %s does not have an ID' % str(self.data[0]))
-        last_id = self.data[0].id
-        for d in self.data[1:]:
-            if d.id is None:
-                d.id = last_id
-            else:
-                last_id = d.id
+        self.data.fill_ids()
         print('Sorted %d entries between %s and %s' % (
             len(self.data),
             self.data[0].when.strftime(GuardState.time_fmt),
             self.data[-1].when.strftime(GuardState.time_fmt),
         ))
 
+    def _stream(self, filename: str, run_size: int):
+        if self.keep_dates:
+            raise ValueError('Cannot keep the dates when streaming')
+        self.data = None
+        print('Streaming from %s' % filename)
+        with open(filename) as f:
+            aggregator = SleepAggregator().update(external_sort(f, run_size))
+        self._from_aggregator(aggregator)
+
+    @classmethod
+    def from_aggregator(cls, aggregator: SleepAggregator):  # -> Schedule
+        # Schedule of already aggregated events (see aggregate_shards), data is None
+        rv = cls.__new__(cls)
+        rv.keep_dates = False
+        rv.data = None
+        rv._by_guard = None
+        rv._guard_events = None
+        rv._dirty = set()
+        rv._sorted = {}
+        rv._shift_index = None
+        rv._index_dirty = set()
+        rv._from_aggregator(aggregator)
+        return rv
+
+    def _from_aggregator(self, aggregator: SleepAggregator):
+        if not aggregator.count:
+            raise ValueError('No data')
+        self._by_guard = aggregator.guards()
+        print('Sorted %d entries between %s and %s' % (
+            aggregator.count,
+            from_minutes(aggregator.first).strftime(GuardState.time_fmt),
+            from_minutes(aggregator.last).strftime(GuardState.time_fmt),
+        ))
+
     def __str__(self):
         return '\n'.join([str(d) for d in self.data])
 
-    def _populate_by_guard(self):  # -> None
-        if self._by_guard is not None:
+    def _guard_info(self, id: int):  # -> GuardInfo
+        events = self._guard_events[id]
+        # the events themselves are only needed to list the dates
+        g = GuardInfo(list(events) if self.keep_dates else None, id=id, first=events.minutes[0])
+        aggregator = SleepAggregator().update(events.events())
+        g.asleep = aggregator.guards_asleep[id]
+        g.set_histogram(
+            aggregator.histogram(id),
+            self._dates_asleep(g) if self.keep_dates else None,
+        )
+        return g
+
+    def _index_events(self):  # -> None
+        if self._guard_events is not None:
             return
+        self._guard_events = {}
+        for minute, id, status in self.data.events():
+            if id not in self._guard_events:
+                self._guard_events[id] = EventStore()
+            self._guard_events[id].append(minute, id, status)
+        self._by_guard = {}
+        self._dirty = set(self._guard_events)
+
+    def guard_events(self):  # -> Dict[int, EventStore]
+        if self.data is None:
+            raise ValueError('No events in this schedule')
+        self._index_events()
+        return self._guard_events
+
+    def shift_index(self):  # -> ShiftIndex
+        # built on first use then only updated for the guards affected by append
+        if self._shift_index is None:
+            self._shift_index = ShiftIndex.from_schedule(self)
+        else:
+            for id in self._index_dirty:
+                if self._guard_events.get(id):
+                    self._shift_index.set_guard(id, self._guard_events[id])
+                else:
+                    self._shift_index.remove_guard(id)
+        self._index_dirty = set()
+        return self._shift_index
 
-        by_guard: Dict[int, GuardInfo] = {}
-        for d in self.data:
-            if d.id in by_guard:
-                by_guard[d.id].data.append(d)
+    def _populate_by_guard(self):  # -> None
+        if self._by_guard is None:
+            self._index_events()
+
+        for id in self._dirty:
+            if self._guard_events[id]:
+                self._by_guard[id] = self._guard_info(id)
             else:
-                by_guard[d.id] = GuardInfo([d])
-
-        for g in by_guard.values():
-            previous = g.data[0]
-            total_asleep = 0
-            minutes_asleep: Dict[int, List[date]] = {}
-            assert previous.is_awake, 'Assuming a guard starts duty awake, got %s' % str(previous)
-            for d in g.data[1:]:
-                time_diff = d.when - previous.when
-                if previous.is_asleep:
-                    if time_diff.seconds < 23 * 3600:
-                        # If the time delta is 23h the last info is not from today's shift
-                        total_asleep += time_diff.seconds // 60
-                        curr_time = previous.when
-                        while curr_time < d.when:
-                            if 0 == curr_time.hour:
-                                minute = curr_time.minute
-                                if minute in minutes_asleep:
-                                    minutes_asleep[minute].append(curr_time.date())
-                                else:
-                                    minutes_asleep[minute] = [curr_time.date()]
-                            curr_time += timedelta(minutes=1)
+                del self._guard_events[id]
+                self._by_guard.pop(id, None)
+        self._dirty = set()
+
+    def _move_event(self, position: int, id: int):
+        # moves the event at position in data from its guard's events to the events of guard id
+        minute = self.data.minutes[position]
+        status = self.data.statuses[position]
+        previous = self.data.ids[position]
+        if previous >= 0 and previous in self._guard_events:
+            events = self._guard_events[previous]
+            i = bisect.bisect_left(events.minutes, minute)
+            while events.statuses[i] != status:
+                i += 1
+            del events.minutes[i]
+            del events.ids[i]
+            del events.statuses[i]
+            self._dirty.add(previous)
+        self.data.ids[position] = id
+        if id not in self._guard_events:
+            self._guard_events[id] = EventStore()
+        events = self._guard_events[id]
+        events.insert(events.bisect_right(minute), minute, id, status)
+        self._dirty.add(id)
+
+    def append(self, events: Iterable, window: int=MINUTES_PER_DAY):  # -> Set[int]
+        """Adds events (GuardState or log lines) to the schedule
+
+        Events may arrive out of order but no earlier than window minutes before the
+        latest event. Only the guards affected are aggregated again when by_guard is next
+        called, their ids are returned.
+        """
+        if self.data is None:
+            raise ValueError('Cannot append to a schedule without its events')
+        self._index_events()
+        events = [
+            GuardState.parse(e.rstrip()) if isinstance(e, str) else (e.minute, e.id, e.status)
+            for e in events
+        ]
+        events.sort(key=lambda e: e[0])
+
+        latest = self.data.minutes[-1]
+        for minute, id, status in events:
+            if minute < latest - window:
+                raise ValueError('%s is more than %d minutes before the latest event' % (
+                    str(GuardState.from_minutes(minute, id, status)), window))
+
+        minutes, ids, statuses = self.data.minutes, self.data.ids, self.data.statuses
+        affected = set()
+        for minute, id, status in events:
+            pos = self.data.bisect_right(minute)
+            # only the beginning of a shift names its guard
+            self.data.insert(pos, minute, id if Status.Begin == status else None, status)
+            # the events after the new one until the next shift belong to its guard
+            i = pos
+            current = ids[pos - 1] if pos > 0 else -1
+            while i < len(minutes) and (i == pos or Status.Begin != statuses[i]):
+                if Status.Begin == statuses[i]:
+                    current = ids[i]
+                if current < 0:
+                    raise ValueError('First entry %s does not have an ID' % str(self.data[i]))
+                if i == pos or ids[i] != current:
+                    if i == pos:
+                        ids[i] = -1
                     else:
-                        assert False, 'Unexpected guard still asleep at the end of the shift %s (diff=%s prev=%s)' % (
-                            str(d),
-                            str(time_diff),
-                            str(previous),
-                        )
-                previous = d
+                        affected.add(ids[i])
+                    self._move_event(i, current)
+                    affected.add(current)
+                i += 1
+            latest = max(latest, minute)
 
-            g.asleep = total_asleep
-            g.by_minutes = sorted([
-                GuardInfo.MinDetails(k, v)
-                for k, v in minutes_asleep.items()
-            ], key=lambda v: v.length, reverse=True)
+        if affected:
+            self._sorted = {}
+            self._index_dirty |= affected
+        return affected
 
-        self._by_guard = by_guard.values()
+    @classmethod
+    def _dates_asleep(cls, guard: GuardInfo):  # -> Dict[int, List[date]]
+        # the dates the guard was asleep at each minute of the midnight hour
+        minutes_asleep: Dict[int, List[date]] = {}
+        for previous, d in zip(guard.data, guard.data[1:]):
+            if not previous.is_asleep:
+                continue
+            curr_time = previous.when
+            while curr_time < d.when:
+                if 0 == curr_time.hour:
+                    minutes_asleep.setdefault(curr_time.minute, []).append(curr_time.date())
+                curr_time += timedelta(minutes=1)
+        return minutes_asleep
 
     def by_guard(self, sort_by_total=True):
         self._populate_by_guard()
-        if sort_by_total:
-            return sorted(self._by_guard, key=lambda v: v.asleep, reverse=True)
-        return sorted(self._by_guard, key=lambda v: v.worst_length, reverse=True)
+        if sort_by_total not in self._sorted:
+            guards = list(self._by_guard.values())
+            if self.data is not None:
+                # by order of first appearance, like when loaded at once
+                guards.sort(key=lambda v: v.first)
+            if sort_by_total:
+                self._sorted[sort_by_total] = sorted(guards, key=lambda v: v.asleep, reverse=True)
+            else:
+                self._sorted[sort_by_total] = sorted(guards, key=lambda v: v.worst_length, reverse=True)
+        return list(self._sorted[sort_by_total])
+
+
+def benchmark(n_lines: int=10 ** 7):
+    # compares both GuardState.from_str paths on a synthetic log
+    lines = []
+    day = date(1518, 1, 1).toordinal()
+    guard = 10
+    while len(lines) < n_lines:
+        when = date.fromordinal(day).strftime('%Y-%m-%d')
+        lines.append('[%s 00:00] Guard #%d begins shift' % (when, guard))
+        lines.append('[%s 00:%02d] falls asleep' % (when, day % 30))
+        lines.append('[%s 00:%02d] wakes up' % (when, 30 + day % 29))
+        day += 1
+        guard = 10 + day % 97
+    lines = lines[:n_lines]
+
+    timings = {}
+    for fast in (False, True):
+        start = time.perf_counter()
+        for l in lines:
+            GuardState.from_str(l, fast=fast)
+        timings[fast] = time.perf_counter() - start
+        print('%s parser: %d lines in %.2fs' % ('fast' if fast else 'strptime', n_lines, timings[fast]))
+    print('speed-up x%.1f' % (timings[False] / timings[True]))
+    return timings
 
 
 if '__main__' == __name__:
 
+    if len(sys.argv) > 1 and 'benchmark' == sys.argv[1]:
+        benchmark(*[int(a) for a in sys.argv[2:3]])
+        sys.exit(0)
+
     rotations = Schedule('input.txt')
 
     by_total = rotations.by_guard()[0]
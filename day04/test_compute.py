@@ -1,8 +1,12 @@
-from datetime import datetime
+import json
+from datetime import date, datetime
 
 import pytest
 
-from day04.compute import Schedule, GuardState, Status
+from day04.compute import (
+    EventStore, GuardState, Schedule, SleepAggregator, Status, aggregate_shards, external_sort, from_minutes,
+    minute_histogram, to_minutes,
+)
 
 
 @pytest.mark.parametrize('filename', ('test1.txt', 'test1_unordered.txt'))
@@ -60,3 +64,211 @@ def test_by_guard():
 
     guard = by_minute[1]
     assert 10 == guard.id, 'guard=%s' % str(guard)
+
+
+def test_minute_histogram():
+    histogram = minute_histogram([5, 30, 24, 1438], [20, 25, 5, 4])
+    assert 1440 == len(histogram)
+    assert [1, 1, 0] == histogram[[0, 1, 2]].tolist()
+    assert [1, 1] == histogram[[1438, 1439]].tolist()
+    assert 2 == histogram[24]
+    assert 0 == histogram[29]
+    assert 1 == histogram[30]
+    assert 0 == histogram[55]
+
+
+@pytest.mark.parametrize('keep_dates', (False, True))
+def test_histogram(keep_dates):
+    rotations = Schedule('test1.txt', keep_dates=keep_dates)
+    guard = rotations.by_guard()[0]
+    assert 10 == guard.id
+    assert 60 == len(guard.histogram)
+    assert 50 == guard.histogram.sum()
+    assert 2 == guard.worst_length
+    assert 24 == guard.by_minutes[0].minute
+    assert 2 == guard.by_minutes[0].length
+    if keep_dates:
+        assert [date(1518, 11, 1), date(1518, 11, 3)] == guard.by_minutes[0].values
+    else:
+        assert guard.by_minutes[0].values is None
+
+
+@pytest.mark.parametrize('line', (
+    '[1518-11-01 00:00] Guard #10 begins shift',
+    '[1518-11-01 23:58] Guard #99 begins shift',
+    '[1518-02-28 00:05] falls asleep',
+    '[1518-12-31 00:25] wakes up',
+    '[1518-11-01 00:25] Wakes up',
+))
+def test_fast_parser(line):
+    expected = GuardState.from_str(line, fast=False)
+    rv = GuardState.from_str(line)
+    assert expected == rv, '%s == %s' % (str(expected), str(rv))
+    assert expected.when == rv.when
+
+
+def test_minutes():
+    when = datetime(1518, 11, 1, 23, 58)
+    minutes = to_minutes(when)
+    assert 23 * 60 + 58 == minutes % (24 * 60)
+    assert when == from_minutes(minutes)
+    assert 2 == to_minutes(datetime(1518, 11, 2, 0, 0)) - minutes
+
+
+@pytest.mark.parametrize('run_size', (1, 2, 5, 1000))
+def test_external_sort(run_size):
+    expected = Schedule('test1.txt')
+    with open('test1_unordered.txt') as f:
+        events = list(external_sort(f, run_size=run_size, block_size=2))
+    assert [(d.minute, d.status) for d in expected.data] == [(e[0], e[2]) for e in events]
+    assert [10, 99, 10, 99, 99] == [e[1] for e in events if e[1] is not None]
+
+
+@pytest.mark.parametrize('filename', ('test1.txt', 'test1_unordered.txt'))
+def test_streaming(filename):
+    expected = Schedule('test1.txt').by_guard()
+    rotations = Schedule(filename, run_size=3)
+    assert rotations.data is None
+    rv = rotations.by_guard()
+    assert [g.id for g in expected] == [g.id for g in rv]
+    assert [g.asleep for g in expected] == [g.asleep for g in rv]
+    assert [g.histogram.tolist() for g in expected] == [g.histogram.tolist() for g in rv]
+    assert [g.id for g in rotations.by_guard(sort_by_total=False)] == [99, 10]
+
+
+def _write_shards(tmp_path, cuts):
+    with open('test1.txt') as f:
+        lines = f.read().splitlines()
+    filenames = []
+    for i, (start, end) in enumerate(zip([0] + cuts, cuts + [len(lines)])):
+        filename = str(tmp_path / ('shard%d.txt' % i))
+        with open(filename, 'w') as f:
+            # unordered within the shard
+            f.write('\n'.join(reversed(lines[start:end])) + '\n')
+        filenames.append(filename)
+    return filenames
+
+
+@pytest.mark.parametrize('cuts', ([3], [1, 2, 3], [4, 7, 13], list(range(1, 17))))
+@pytest.mark.parametrize('processes', (1, 2))
+def test_aggregate_shards(tmp_path, cuts, processes):
+    expected = Schedule('test1.txt').by_guard()
+    filenames = _write_shards(tmp_path, cuts)
+    rv = Schedule.from_aggregator(aggregate_shards(filenames, processes=processes, run_size=2)).by_guard()
+    assert [(g.id, g.asleep, g.histogram.tolist()) for g in expected] == \
+        [(g.id, g.asleep, g.histogram.tolist()) for g in rv]
+
+
+def test_aggregator_fixed_size():
+    aggregator = SleepAggregator()
+    for day in range(1000):
+        midnight = day * 24 * 60
+        aggregator.add(midnight - 5, 7, Status.Begin)
+        aggregator.add(midnight + day % 50, None, Status.Asleep)
+        aggregator.add(midnight + 55, None, Status.Awake)
+    expected = minute_histogram([d % 50 for d in range(1000)], [55 - d % 50 for d in range(1000)])
+    assert expected[:60].tolist() == aggregator.histogram(7).tolist()
+    # the state of a guard does not grow with the log
+    assert [7] == list(aggregator._diffs)
+    assert 2 * 24 * 60 + 1 == aggregator._diffs[7].size
+
+
+def test_merge_any_order(tmp_path):
+    expected = Schedule('test1.txt').by_guard()
+    partials = []
+    for filename in _write_shards(tmp_path, [2, 5, 9, 12]):
+        with open(filename) as f:
+            partial = SleepAggregator(partial=True).update(external_sort(f))
+        # round trip through JSON like between machines
+        partials.append(SleepAggregator.from_dict(json.loads(json.dumps(partial.to_dict()))))
+
+    a, b, c, d, e = partials
+    for merged in (e.merge(a).merge(c.merge(d)).merge(b), SleepAggregator.reduce([d, b, a, e, c])):
+        rv = Schedule.from_aggregator(merged).by_guard()
+        assert [(g.id, g.asleep, g.histogram.tolist()) for g in expected] == \
+            [(g.id, g.asleep, g.histogram.tolist()) for g in rv]
+
+    # the first shard is missing: its guard is not known
+    with pytest.raises(ValueError):
+        SleepAggregator.reduce([b, c, d, e]).resolve()
+
+
+def test_append(tmp_path):
+    expected = Schedule('test1.txt')
+    with open('test1_unordered.txt') as f:
+        lines = f.read().splitlines()
+    # the first shift of #10 is complete in the first lines
+    filename = str(tmp_path / 'start.txt')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(sorted(lines)[:5]) + '\n')
+    rotations = Schedule(filename)
+    guards = rotations.by_guard()
+    assert [(10, 45)] == [(g.id, g.asleep) for g in guards]
+    assert guards is not rotations.by_guard()
+    assert [id(g) for g in guards] == [id(g) for g in rotations.by_guard()]
+
+    rest = sorted(lines)[5:]
+    assert {99} == rotations.append(rest[:3])
+    guard_10 = [g for g in rotations.by_guard() if 10 == g.id][0]
+    assert guard_10 is guards[0], 'guard #10 should not be aggregated again'
+
+    assert {10, 99} == rotations.append(reversed(rest[3:]), window=2 * 24 * 60)
+    assert expected.data == rotations.data
+    rv = rotations.by_guard()
+    assert [(g.id, g.asleep, g.histogram.tolist()) for g in expected.by_guard()] == \
+        [(g.id, g.asleep, g.histogram.tolist()) for g in rv]
+
+
+def test_append_out_of_order():
+    rotations = Schedule('test1.txt')
+    # guard #42 took over the second half of #10's first shift
+    assert {10, 42} == rotations.append(['[1518-11-01 00:27] Guard #42 begins shift'], window=10 ** 6)
+    by_id = {g.id: g for g in rotations.by_guard()}
+    assert 20 + 5 == by_id[10].asleep
+    assert 25 == by_id[42].asleep
+
+    with pytest.raises(ValueError):
+        rotations.append(['[1518-11-01 00:28] wakes up'])
+    with pytest.raises(ValueError):
+        Schedule('test1.txt', run_size=10).append(['[1518-11-06 00:00] Guard #10 begins shift'])
+
+
+def test_event_store():
+    with open('test1_unordered.txt') as f:
+        store = EventStore.from_lines(f)
+    assert 17 == len(store)
+    assert 13 * 17 == store.nbytes
+    assert GuardState(datetime(1518, 11, 1, 0, 5), None, Status.Asleep) == store[1]
+    store.fill_ids()
+    assert GuardState(datetime(1518, 11, 1, 0, 5), 10, Status.Asleep) == store[1]
+    assert Schedule('test1.txt').data == store
+    assert list(Schedule('test1.txt').data) == list(store)
+    assert [10, 10] == [d.id for d in store[3:5]]
+    assert 5 == store.bisect_right(store.minutes[4])
+
+    with pytest.raises(ValueError):
+        EventStore.from_lines(['[1518-11-01 00:05] falls asleep']).fill_ids()
+
+
+def test_shift_index():
+    rotations = Schedule('test1.txt')
+    index = rotations.shift_index()
+    assert [1 << 24 | 1 << 25 | 1 << 26 | 1 << 27 | 1 << 28] == index.masks[10][1:]
+    assert [(10, 50), (99, 30)] == index.sleepiest_guards(2)
+    assert [(99, 30), (10, 5)] == index.sleepiest_guards(2, date(1518, 11, 2), date(1518, 11, 5))
+    assert [(99, 3)] == index.top_guards_by_minute(45)
+    assert [(10, 2), (99, 0)] == index.top_guards_by_minute(24, k=5)
+    assert (24, 2) == index.sleepiest_minute(10)
+    assert (40, 2) == index.sleepiest_minute(99, end=date(1518, 11, 4))
+    assert (None, 0) == index.sleepiest_minute(10, date(1518, 11, 2), date(1518, 11, 2))
+
+    for g in rotations.by_guard():
+        assert g.asleep == index.asleep(g.id)
+        assert g.histogram.tolist() == index.minute_counts(g.id).tolist()
+
+    # only the guards affected by the new events are indexed again
+    rotations.append(['[1518-11-01 00:27] Guard #42 begins shift'], window=10 ** 6)
+    masks_99 = index.masks[99]
+    assert index is rotations.shift_index()
+    assert masks_99 is index.masks[99]
+    assert [(42, 25), (10, 20)] == index.sleepiest_guards(2, end=date(1518, 11, 1))
@@ -1,10 +1,16 @@
 """
 Answer to https://adventofcode.com/2018/day/%
 """
+import mmap
+import os
+import random
 import re
 import string
-
+import sys
+import time
 from collections import namedtuple
+from multiprocessing import Pool
+from typing import List, Tuple
 
 
 def is_reacting(unitA: str, unitB: str):  # -> bool
@@ -14,34 +20,379 @@ def is_reacting(unitA: str, unitB: str):  # -> bool
 ReactionInfo = namedtuple('ReactionInfo', ['polymere', 'reactions', 'removed'])
 
 
-def reaction(polymere: str):  # -> str
-    assert len(polymere) > 1
-    rv = polymere
-    curr = 1
+def _reduce(units: bytes):  # -> Tuple[bytearray, int]
+    # the surviving units: each new unit can only react with the last survivor
+    # a unit and its opposite polarity only differ by the ASCII case bit (32)
+    stack = bytearray()
     n_reaction = 0
+    for unit in units:
+        if stack and 32 == stack[-1] ^ unit:
+            stack.pop()
+            n_reaction += 1
+        else:
+            stack.append(unit)
+    return stack, n_reaction
+
+
+def _merge(left: Tuple[bytes, int], right: Tuple[bytes, int]):  # -> Tuple[bytes, int]
+    # both sides are already reduced so only the units meeting at the boundary can react
+    left_units, right_units = left[0], right[0]
+    n = 0
+    while n < len(left_units) and n < len(right_units) and 32 == left_units[-1 - n] ^ right_units[n]:
+        n += 1
+    return left_units[:len(left_units) - n] + right_units[n:], left[1] + right[1] + n
+
+
+def _merge_tree(parts: List[Tuple[bytes, int]]):  # -> Tuple[bytes, int]
+    while len(parts) > 1:
+        merged = [_merge(a, b) for a, b in zip(parts[::2], parts[1::2])]
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def reaction(polymere: str, processes: int=1, chunk_size: int=1 << 24):  # -> ReactionInfo
+    """Fully react the polymere
+
+    :param processes: number of workers reducing chunks of the polymere, None uses every core
+    :param chunk_size: number of units given to a worker at once
+    """
+    assert len(polymere) > 1
 
     print('Compressing polymere of %d units' % len(polymere))
 
-    while curr < len(rv):
-        prev = curr - 1
-        # prev < 0 may happen when a lot of collapsing occurs
-
-        if prev >= 0 and is_reacting(rv[prev], rv[curr]):
-            old = rv
-            try:
-                rv = old[:prev] + old[curr + 1:]
-            except MemoryError:
-                print('at location prev=%d curr=%d' % (prev, curr))
-                raise
-            curr -= 2  # re-evaluate the previous step
-            n_reaction += 1
+    units = polymere.encode('ascii')
+    if 1 == processes or len(units) <= chunk_size:
+        stack, n_reaction = _reduce(units)
+    else:
+        # reductions can be grouped in any way: reduce the chunks then cancel their boundaries
+        chunks = [units[i:i + chunk_size] for i in range(0, len(units), chunk_size)]
+        with Pool(processes) as pool:
+            parts = pool.map(_reduce, chunks)
+        stack, n_reaction = _merge_tree(parts)
+
+    return ReactionInfo(stack.decode('ascii'), n_reaction, None)
+
+
+class ReactionEngine(object):
+    """Streaming reaction
+
+    The polymere is consumed in blocks (from a memory mapped file or a pipe) and only the
+    surviving units are kept, so memory is bounded by the reduced polymere. The units of
+    each type read are counted (see best_simplification).
+    """
+
+    def __init__(self):
+        self.stack = bytearray()
+        self.units = 0
+        self.unit_counts = dict.fromkeys(string.ascii_lowercase, 0)
+        self.reactions = 0
+        self.peak_nbytes = 0
+
+    @property
+    def nbytes(self):
+        return len(self.stack)
+
+    def __str__(self):
+        return 'units=%d reactions=%d survivors=%d peak_memory=%d bytes' % (
+            self.units, self.reactions, len(self.stack), self.peak_nbytes,
+        )
+
+    def consume(self, block):  # -> ReactionEngine
+        if isinstance(block, str):
+            block = block.encode('ascii')
+        block = bytes(block).translate(None, b' \t\r\n')
+        self.units += len(block)
+        for unit in string.ascii_lowercase:
+            self.unit_counts[unit] += block.count(ord(unit)) + block.count(ord(unit.upper()))
+
+        part, n_reaction = _reduce(block)
+        self.peak_nbytes = max(self.peak_nbytes, len(self.stack) + len(part))
+        # same as _merge without copying the survivors
+        stack = self.stack
+        n = 0
+        while n < len(stack) and n < len(part) and 32 == stack[-1 - n] ^ part[n]:
+            n += 1
+        del stack[len(stack) - n:]
+        stack += part[n:]
+        self.reactions += n_reaction + n
+        return self
+
+    def info(self):  # -> ReactionInfo
+        return ReactionInfo(self.stack.decode('ascii'), self.reactions, None)
+
+    @classmethod
+    def from_source(cls, source, block_size: int=1 << 20, report_every: int=None):  # -> ReactionEngine
+        # source is a filename or a file-like object (file, pipe, ...)
+        rv = cls()
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                if 0 == os.fstat(f.fileno()).st_size:
+                    return rv
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for n, i in enumerate(range(0, len(data), block_size), 1):
+                        rv.consume(data[i:i + block_size])
+                        if report_every and 0 == n % report_every:
+                            print(str(rv))
+            return rv
+
+        n = 0
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            rv.consume(block)
+            n += 1
+            if report_every and 0 == n % report_every:
+                print(str(rv))
+        return rv
+
+
+class PolymerTree(object):
+    """Editable polymere: rope over blocks of units
+
+    Every node keeps its number of units, the length of its reduced fragment, the number
+    of reactions it took and how many units of its children's fragments cancel at their
+    boundary: only the blocks (leaves) store their reduced units. As fragments are
+    reduced, merging two nodes only compares the units meeting at their boundary, read
+    through the tree rather than copied, so an edit or a range query takes O(log n)
+    merges rather than a full reaction and the tree holds O(n) units. The reduced
+    polymere is only built by reaction and range_reaction.
+
+    A block growing past 2 * block_size is split in two where it is, a subtree is only
+    rebuilt (from its blocks, which are not reduced again) once it gets too deep.
+    """
+
+    class Node(object):
+        __slots__ = ('left', 'right', 'parent', 'block', 'stack', 'units', 'length', 'reactions', 'cut', 'height',
+                     'leaves')
+
+        def __init__(self, block: bytearray=None):
+            self.left = None
+            self.right = None
+            self.parent = None
+            # leaves only: the units and their reduction
+            self.block = block
+            self.stack = b''
+            self.units = 0
+            self.length = 0
+            self.reactions = 0
+            # number of units of each child cancelled at their boundary (internal nodes only)
+            self.cut = 0
+            self.height = 0
+            self.leaves = 1
+
+    def __init__(self, polymere: str='', block_size: int=256):
+        self.block_size = block_size
+        units = polymere.encode('ascii')
+        blocks = [bytearray(units[i:i + block_size]) for i in range(0, len(units), block_size)] or [bytearray()]
+        self.root = self._join([self._leaf(b) for b in blocks])
+
+    def _leaf(self, block: bytearray):  # -> PolymerTree.Node
+        node = PolymerTree.Node(block)
+        self._set_leaf(node)
+        return node
 
-        # if (curr + n_reaction) % 10000 == 9999:
-            # print('Current polymere is %d units long after %d reactions (curr=%d)' % (len(rv), n_reaction, curr))
+    @staticmethod
+    def _set_leaf(node: Node):
+        stack, n_reaction = _reduce(node.block)
+        node.units = len(node.block)
+        node.stack = bytes(stack)
+        node.length = len(stack)
+        node.reactions = n_reaction
 
-        curr += 1
+    def _join(self, nodes: List[Node]):  # -> PolymerTree.Node
+        # balanced tree over the nodes
+        while len(nodes) > 1:
+            joined = []
+            for left, right in zip(nodes[::2], nodes[1::2]):
+                node = PolymerTree.Node()
+                node.left, node.right = left, right
+                left.parent = right.parent = node
+                self._pull(node)
+                joined.append(node)
+            if len(nodes) % 2:
+                joined.append(nodes[-1])
+            nodes = joined
+        nodes[0].parent = None
+        return nodes[0]
 
-    return ReactionInfo(rv, n_reaction, None)
+    @staticmethod
+    def _unit(node: Node, k: int):  # -> int
+        # k-th unit of the reduced fragment of the node
+        while node.left is not None:
+            head = node.left.length - node.cut
+            if k < head:
+                node = node.left
+            else:
+                k += node.cut - head
+                node = node.right
+        return node.stack[k]
+
+    def _pull(self, node: Node):
+        left, right = node.left, node.right
+        # both sides are already reduced so only the units meeting at the boundary can react
+        n = 0
+        while n < left.length and n < right.length and \
+                32 == self._unit(left, left.length - 1 - n) ^ self._unit(right, n):
+            n += 1
+        node.cut = n
+        node.units = left.units + right.units
+        node.length = left.length + right.length - 2 * n
+        node.reactions = left.reactions + right.reactions + n
+        node.height = 1 + max(left.height, right.height)
+        node.leaves = left.leaves + right.leaves
+
+    def _update(self, node: Node):
+        if len(node.block) > 2 * self.block_size:
+            # the leaf becomes the parent of its 2 halves
+            half = len(node.block) // 2
+            node.left, node.right = self._leaf(node.block[:half]), self._leaf(node.block[half:])
+            node.left.parent = node.right.parent = node
+            node.block, node.stack = None, b''
+        else:
+            self._set_leaf(node)
+            node = node.parent
+        deep = None
+        while node is not None:
+            self._pull(node)
+            if node.height > 2 * node.leaves.bit_length():
+                deep = node
+            node = node.parent
+        if deep is not None:
+            self._rebuild(deep)
+
+    def _rebuild(self, node: Node):
+        # balances the subtree of the node
+        parent = node.parent
+        subtree = self._join(list(self._leaves(node)))
+        subtree.parent = parent
+        if parent is None:
+            self.root = subtree
+            return
+        if parent.left is node:
+            parent.left = subtree
+        else:
+            parent.right = subtree
+        while parent is not None:
+            self._pull(parent)
+            parent = parent.parent
+
+    @staticmethod
+    def _leaves(node: Node):  # -> Iterator[PolymerTree.Node]
+        # in order
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            if node.left is None:
+                yield node
+            else:
+                pending.append(node.right)
+                pending.append(node.left)
+
+    def _locate(self, position: int, inserting: bool=False):  # -> Tuple[PolymerTree.Node, int]
+        # returns the leaf holding the unit at position and the unit's offset in it
+        if position < 0 or position > len(self) or (position == len(self) and not inserting):
+            raise IndexError('position %d out of range' % position)
+        node = self.root
+        while node.left is not None:
+            left = node.left.units
+            if position < left or (inserting and position == left):
+                node = node.left
+            else:
+                position -= left
+                node = node.right
+        return node, position
+
+    def __len__(self):
+        return self.root.units
+
+    def __str__(self):
+        return b''.join(leaf.block for leaf in self._leaves(self.root)).decode('ascii')
+
+    def __getitem__(self, position: int):  # -> str
+        leaf, offset = self._locate(position)
+        return chr(leaf.block[offset])
+
+    def __setitem__(self, position: int, unit: str):
+        leaf, offset = self._locate(position)
+        leaf.block[offset] = ord(unit)
+        self._update(leaf)
+
+    def __delitem__(self, position: int):
+        leaf, offset = self._locate(position)
+        del leaf.block[offset]
+        self._update(leaf)
+
+    def insert(self, position: int, unit: str):
+        leaf, offset = self._locate(position, inserting=True)
+        leaf.block.insert(offset, ord(unit))
+        self._update(leaf)
+
+    def reduced_length(self):  # -> int
+        return self.root.length
+
+    def _collect(self, node: Node, start: int, end: int, pieces: List[bytes]):
+        # units [start, end) of the reduced fragment of the node
+        if start >= end:
+            return
+        if node.left is None:
+            pieces.append(node.stack[start:end])
+            return
+        head = node.left.length - node.cut
+        if start < head:
+            self._collect(node.left, start, min(end, head), pieces)
+        if end > head:
+            self._collect(node.right, max(start, head) - head + node.cut, end - head + node.cut, pieces)
+
+    def reaction(self):  # -> ReactionInfo
+        pieces = []
+        self._collect(self.root, 0, self.root.length, pieces)
+        return ReactionInfo(b''.join(pieces).decode('ascii'), self.root.reactions, None)
+
+    def _parts(self, start: int, end: int, node: Node, parts: List[Node]):
+        # nodes covering the node's units [start, end), the ends of leaves reduced apart
+        if start <= 0 and end >= node.units:
+            parts.append(node)
+        elif node.left is None:
+            parts.append(self._leaf(node.block[max(start, 0):end]))
+        else:
+            left = node.left.units
+            if start < left:
+                self._parts(start, min(end, left), node.left, parts)
+            if end > left:
+                self._parts(start - left, end - left, node.right, parts)
+
+    def range_reaction(self, start: int, end: int):  # -> ReactionInfo
+        # reaction of the units [start, end)
+        start, end = max(start, 0), min(end, len(self))
+        if start >= end:
+            return ReactionInfo('', 0, None)
+        parts = []
+        self._parts(start, end, self.root, parts)
+        # (node, start, end) of the reduced fragments left after the parts so far
+        segments = []
+        n_reaction = 0
+        for part in parts:
+            n_reaction += part.reactions
+            k = 0
+            while segments and k < part.length:
+                node, first, last = segments[-1]
+                if 32 != self._unit(node, last - 1) ^ self._unit(part, k):
+                    break
+                k += 1
+                n_reaction += 1
+                if first == last - 1:
+                    segments.pop()
+                else:
+                    segments[-1] = (node, first, last - 1)
+            if k < part.length:
+                segments.append((part, k, part.length))
+        pieces = []
+        for node, first, last in segments:
+            self._collect(node, first, last, pieces)
+        return ReactionInfo(b''.join(pieces).decode('ascii'), n_reaction, None)
 
 
 def simplification(polymere: str, unit: str):
@@ -50,31 +401,124 @@ def simplification(polymere: str, unit: str):
     return rv
 
 
-def best_simplification(polymere: str):  # -> Tuple[str, str]
-    best_reacted = ReactionInfo(polymere, 0, None)  # not an actual reaction
+def _removal(args: Tuple[bytes, str]):  # -> Tuple[bytearray, int]
+    polymere, unit = args
+    return _reduce(polymere.translate(None, (unit.lower() + unit.upper()).encode('ascii')))
 
+
+def best_simplification(polymere: str, processes: int=1, unit_counts=None):  # -> ReactionInfo
+    """Find the unit whose removal gives the shortest reaction
+
+    :param processes: 1 gets every removal length from a single walk (see removal_lengths)
+        in this process, otherwise the 26 removals are reacted by a pool of workers
+        (None uses every core)
+    :param unit_counts: number of units of each (lower case) type of the original polymere
+        when polymere is its reduction (see ReactionEngine.unit_counts), the reactions are
+        then counted from the original polymere
+    """
+    if unit_counts is None:
+        unit_counts = {u: polymere.count(u) + polymere.count(u.upper()) for u in string.ascii_lowercase}
+    n_units = sum(unit_counts.values())
+
+    start = time.time()
+    # removing a unit never undoes a reaction: work on the reduced polymere
+    reduced = bytes(_reduce(polymere.encode('ascii'))[0])
+    if 1 == processes:
+        lengths = _removal_lengths(reduced)
+        unit = min(string.ascii_lowercase, key=lengths.get)
+        if lengths[unit] >= len(polymere):
+            return ReactionInfo(polymere, 0, None)  # not an actual reaction
+        stack, _ = _removal((reduced, unit))
+    else:
+        jobs = [(reduced, unit) for unit in string.ascii_lowercase]
+        with Pool(processes) as pool:
+            results = pool.map(_removal, jobs)
+        # first unit of the shortest stack, like min over the lengths
+        unit, stack = min(zip(string.ascii_lowercase, (s for s, _ in results)), key=lambda r: len(r[1]))
+        if len(stack) >= len(polymere):
+            return ReactionInfo(polymere, 0, None)  # not an actual reaction
+
+    # same count as reacting the simplified polymere from scratch
+    n_reaction = (n_units - unit_counts[unit] - len(stack)) // 2
+    print('Best polymere of %d units when removing %s, found in %.3fs' % (len(stack), unit, time.time() - start))
+    return ReactionInfo(stack.decode('ascii'), n_reaction, unit)
+
+
+def _removal_lengths(reduced: bytes):  # -> Dict[str, int]
+    # indexed by the lower case unit
+    stacks = [bytearray() for _ in range(128)]
+    starts = [0] * 128
+
+    def push(stack: bytearray, start: int, end: int):
+        n = 0
+        while n < len(stack) and start + n < end and 32 == stack[-1 - n] ^ reduced[start + n]:
+            n += 1
+        del stack[len(stack) - n:]
+        stack += reduced[start + n:end]
+
+    for i, unit in enumerate(reduced):
+        lane = unit | 32
+        if starts[lane] < i:
+            push(stacks[lane], starts[lane], i)
+        starts[lane] = i + 1
+
+    rv = {}
     for unit in string.ascii_lowercase:
-        simplified = simplification(polymere, unit)
-        reacted = reaction(simplified)
+        lane = ord(unit)
+        push(stacks[lane], starts[lane], len(reduced))
+        rv[unit] = len(stacks[lane])
+    return rv
+
+
+def removal_lengths(polymere: str):  # -> Dict[str, int]
+    """Reduced length of the polymere without each unit, all in one walk
+
+    Removing a unit cuts the reduced polymere into segments that are already reduced,
+    so each unit gets its own stack onto which the segments between its occurrences are
+    appended, only cancelling at the boundaries. The walk takes one step per unit
+    rather than 26 reactions of the whole polymere, but each surviving unit is still
+    copied into the stacks of the (up to 25) other units.
+    """
+    return _removal_lengths(bytes(_reduce(polymere.encode('ascii'))[0]))
+
+
+def benchmark(n_units: int=10 ** 6):
+    # compares removal_lengths with one reaction per removed unit on a random polymere
+    rng = random.Random(5)
+    polymere = ''.join(rng.choice(string.ascii_letters) for _ in range(n_units))
+    reduced = bytes(_reduce(polymere.encode('ascii'))[0])
+    print('Reduced polymere is %d units long' % len(reduced))
+
+    start = time.perf_counter()
+    expected = {unit: len(_removal((reduced, unit))[0]) for unit in string.ascii_lowercase}
+    separate = time.perf_counter() - start
+    print('26 reactions: %.3fs' % separate)
 
-        if len(reacted.polymere) < len(best_reacted.polymere):
-            best_reacted = ReactionInfo(reacted.polymere, reacted.reactions, unit)
-            print('New best polymere of %d units when removing %s' % (len(best_reacted.polymere), unit))
+    start = time.perf_counter()
+    rv = removal_lengths(polymere)
+    single = time.perf_counter() - start
+    print('single walk (with the initial reduction): %.3fs' % single)
 
-    return best_reacted
+    assert expected == rv, 'got %r' % rv
+    print('speed-up x%.1f' % (separate / single))
+    return separate, single
 
 
 if '__main__' == __name__:
 
-    with open('input.txt') as f:
-        polymere = ''.join(f.readlines()).rstrip()
+    if len(sys.argv) > 1 and 'benchmark' == sys.argv[1]:
+        benchmark(*[int(a) for a in sys.argv[2:3]])
+        sys.exit(0)
 
-    assert 50000 == len(polymere), 'got %d' % len(polymere)
-    rv = reaction(polymere)  # 11720
+    # python compute.py [filename or - to read stdin]
+    source = sys.argv[1] if len(sys.argv) > 1 else 'input.txt'
+    engine = ReactionEngine.from_source(sys.stdin.buffer if '-' == source else source, report_every=100)
+    print(str(engine))
+    rv = engine.info()  # 11720
 
     print('Original polymere is %d units long after %d reactions' % (len(rv.polymere), rv.reactions))
 
-    rv = best_simplification(polymere)  # 4956
+    rv = best_simplification(rv.polymere, unit_counts=engine.unit_counts)  # 4956
 
     print('Best reduction is %d units long after %d reactions when removing units %s' % (
         len(rv.polymere),
@@ -1,4 +1,11 @@
-from day05.compute import reaction, simplification
+import io
+import random
+
+import pytest
+
+from day05.compute import (
+    PolymerTree, ReactionEngine, ReactionInfo, best_simplification, reaction, removal_lengths, simplification,
+)
 
 
 def test_reaction():
@@ -8,10 +15,97 @@ def test_reaction():
         rv = reaction(input).polymere
         assert expected == rv, 'got %s' % rv
 
+    rv = reaction('dabAcCaCBAcCcaDA')
+    assert 3 == rv.reactions, 'got %d' % rv.reactions
+
     rv = reaction('PpVviIcPpaACHKkhcvNnVhXxtTsSTtbBHUvmMVuUAakKhHyQqYuay').polymere
     assert 'cay' == rv, 'got %s' % rv
 
 
+@pytest.mark.parametrize('chunk_size', (2, 3, 7, 64))
+def test_parallel_reaction(chunk_size):
+    rng = random.Random(5)
+    for _ in range(20):
+        polymere = ''.join(rng.choice('aAbBcC') for _ in range(rng.randint(2, 200)))
+        expected = reaction(polymere)
+        rv = reaction(polymere, processes=2, chunk_size=chunk_size)
+        assert expected == rv, 'got %r' % (rv,)
+
+
+@pytest.mark.parametrize('block_size', (1, 3, 8, 1024))
+def test_reaction_engine(tmp_path, block_size):
+    polymere = 'dabAcCaCBAcCcaDA' * 5
+    expected = reaction(polymere)
+    filename = str(tmp_path / 'polymere.txt')
+    with open(filename, 'w') as f:
+        f.write(polymere + '\n')
+
+    for source in (filename, io.BytesIO(polymere.encode() + b'\n'), io.StringIO(polymere)):
+        engine = ReactionEngine.from_source(source, block_size=block_size)
+        assert expected == engine.info(), 'got %r' % (engine.info(),)
+        assert len(polymere) == engine.units, 'got %d' % engine.units
+        assert {'a': 30, 'b': 10, 'c': 30, 'd': 10, 'e': 0} == {u: engine.unit_counts[u] for u in 'abcde'}
+        assert len(expected.polymere) <= engine.peak_nbytes <= len(expected.polymere) + block_size
+
+    empty = str(tmp_path / 'empty.txt')
+    open(empty, 'w').close()
+    assert ('', 0, None) == ReactionEngine.from_source(empty).info()
+
+
+@pytest.mark.parametrize('block_size', (1, 2, 5))
+def test_polymer_tree(block_size):
+    def expected(units):
+        return ReactionEngine().consume(''.join(units)).info()
+
+    rng = random.Random(block_size)
+    units = list('dabAcCaCBAcCcaDA')
+    tree = PolymerTree(''.join(units), block_size=block_size)
+    assert ReactionInfo('dabCBAcaDA', 3, None) == tree.reaction(), 'got %r' % (tree.reaction(),)
+    assert 10 == tree.reduced_length()
+
+    for _ in range(300):
+        edit = rng.choice(('insert', 'delete', 'replace')) if units else 'insert'
+        if 'insert' == edit:
+            position, unit = rng.randint(0, len(units)), rng.choice('aAbBcC')
+            units.insert(position, unit)
+            tree.insert(position, unit)
+        elif 'delete' == edit:
+            position = rng.randrange(len(units))
+            del units[position]
+            del tree[position]
+        else:
+            position, unit = rng.randrange(len(units)), rng.choice('aAbBcC')
+            units[position] = unit
+            tree[position] = unit
+        assert ''.join(units) == str(tree)
+        assert expected(units) == tree.reaction(), 'got %r after %s' % (tree.reaction(), edit)
+        start = rng.randint(0, len(units))
+        end = rng.randint(start, len(units))
+        rv = tree.range_reaction(start, end)
+        assert expected(units[start:end]) == rv, 'got %r' % (rv,)
+
+    with pytest.raises(IndexError):
+        tree[len(units)]
+    with pytest.raises(IndexError):
+        tree.insert(len(units) + 1, 'a')
+
+
+def test_polymer_tree_local_splits():
+    rng = random.Random(3)
+    units = []
+    tree = PolymerTree(block_size=2)
+    for _ in range(2000):
+        unit = rng.choice('aAbB')
+        units.insert(0, unit)
+        tree.insert(0, unit)
+    expected = ReactionEngine().consume(''.join(units)).info()
+    assert expected == tree.reaction(), 'got %r' % (tree.reaction(),)
+    # the blocks were split where they grew without the tree getting deep
+    assert tree.root.height <= 2 * tree.root.leaves.bit_length(), 'got %d' % tree.root.height
+    rv = tree.range_reaction(100, 1500)
+    assert ReactionEngine().consume(''.join(units[100:1500])).info() == rv, 'got %r' % (rv,)
+
+
 def test_simplification():
     rv = simplification('dabAcCaCBAcCcaDA', 'a')
     assert 'dbcCCBcCcD' == rv, 'got %s' % rv
@@ -21,3 +115,30 @@ def test_simplification():
     assert 'dabAaBAaDA' == rv, 'got %s' % rv
     rv = simplification('dabAcCaCBAcCcaDA', 'd')
     assert 'abAcCaCBAcCcaA' == rv, 'got %s' % rv
+
+
+@pytest.mark.parametrize('processes', (1, 2))
+def test_best_simplification(processes):
+    rv = best_simplification('dabAcCaCBAcCcaDA', processes=processes)
+    assert ReactionInfo('daDA', 3, 'c') == rv, 'got %r' % (rv,)
+
+    # reactions are still counted from the original polymere
+    engine = ReactionEngine().consume('dabAcCaCBAcCcaDA')
+    rv = best_simplification(engine.info().polymere, processes=processes, unit_counts=engine.unit_counts)
+    assert ReactionInfo('daDA', 3, 'c') == rv, 'got %r' % (rv,)
+
+    assert ReactionInfo('b', 0, 'a') == best_simplification('ab', processes=processes)
+
+
+def test_removal_lengths():
+    rv = removal_lengths('dabAcCaCBAcCcaDA')
+    assert {'a': 6, 'b': 8, 'c': 4, 'd': 6} == {u: rv[u] for u in 'abcd'}, 'got %r' % rv
+    assert 10 == rv['z'], 'got %d' % rv['z']
+
+    rng = random.Random(25)
+    for _ in range(50):
+        polymere = ''.join(rng.choice('aAbBcCdD') for _ in range(rng.randint(2, 200)))
+        rv = removal_lengths(polymere)
+        for unit in 'abcde':
+            expected = len(ReactionEngine().consume(simplification(polymere, unit)).info().polymere)
+            assert expected == rv[unit], 'got %d removing %s from %s' % (rv[unit], unit, polymere)